@@ -4,10 +4,36 @@ from utli import try_parse_json_object
 from loguru import logger
 import json
 import aiohttp
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 # import httpx
 import tqdm
 
 
+class LLMResponseError(Exception):
+    """Non-200 response from a chat completion endpoint."""
+
+    def __init__(self, status, text, retry_after=None):
+        super().__init__(f"response status: {status}, response text: {text}")
+        self.status = status
+        self.text = text
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
 class BaseAgent:
     def __init__(self, api_key, base_url, model):
         self.client = OpenAI(
@@ -19,6 +45,59 @@ class BaseAgent:
         self.model = model
 
 
+class PooledSessionAgent(BaseAgent, ABC):
+    """Agent that reuses one keep-alive aiohttp session for all of its requests.
+
+    The session is created lazily inside the running event loop and must be released
+    with ``await agent.close()`` (or by using the agent as an async context manager).
+    """
+
+    def __init__(self, api_key, base_url, model, connection_limit=20, keepalive_timeout=60, request_timeout=300):
+        super().__init__(api_key, base_url, model)
+        self.header = {
+            "Authorization": f"Bearer {api_key}",
+        }
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self._session = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.header,
+                                                  timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        self.get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @abstractmethod
+    def build_request_body(self, input_message, prompt, temperature=0.5, max_tokens=4096) -> dict:
+        ...
+
+    async def post_chat_completion(self, body: dict, proxy=None) -> str:
+        session = self.get_session()
+        async with session.post(f"{self.base_url}/chat/completions", json=body, proxy=proxy) as response:
+            if response.status != 200:
+                response_text = await response.text()
+                logger.error(f"response status: {response.status}, response text: {response_text}")
+                raise LLMResponseError(response.status, response_text,
+                                       retry_after=parse_retry_after(response.headers.get("Retry-After")))
+            result = await response.json()
+            return result["choices"][0]["message"]["content"]
+
+
 class ZhiPuAgent(BaseAgent):
     PATTERN = re.compile(r"```(?:json\s+)?(\W.*?)```", re.DOTALL)
     GLM_JSON_RESPONSE_PREFIX = """You should always follow the instructions and output a valid JSON object.
@@ -56,66 +135,44 @@ class ZhiPuAgent(BaseAgent):
         return result
 
 
-class MoonshotAgent(BaseAgent):
-    def __init__(self, api_key, base_url="https://api.moonshot.cn/v1", model="moonshot-v1-8k"):
-        super().__init__(api_key, base_url, model)
-        self.header = header = {
-            "Authorization": f"Bearer {api_key}",
+class MoonshotAgent(PooledSessionAgent):
+    def __init__(self, api_key, base_url="https://api.moonshot.cn/v1", model="moonshot-v1-8k", **session_kwargs):
+        super().__init__(api_key, base_url, model, **session_kwargs)
+
+    def build_request_body(self, input_message, prompt, temperature=0.5, max_tokens=4096) -> dict:
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": input_message}
+            ],
+            "temperature": temperature,
+            "max_tokens": max_tokens
         }
 
     async def get_response(self, input_message, prompt, temperature=0.5, max_tokens=4096):
-        # completion = self.client.chat.completions.create(
-        #     model=self.model,
-        #     messages=[
-        #         {"role": "system", "content": prompt},
-        #         {"role": "user", "content": input_message}
-        #     ],
-        #     temperature=temperature,
-        #     response_format={"type": "json_object"}
-        # )
-        # result = completion.choices[0].message.content
-        # return result
-        # async with httpx.AsyncClient() as client:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.base_url}/chat/completions", headers=self.header, json={
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": input_message}
-                ],
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }) as response:
-                if response.status != 200:
-                    logger.error(f"response status: {response.status}, response text: {await response.text()}")
-                    raise Exception(f"response status: {response.status}, response text: {await response.text()}")
-                result = await response.json()
-                return result["choices"][0]["message"]["content"]
-
-
-class OpenAIChatAgent(BaseAgent):
-    def __init__(self, api_key, base_url="https://api.openai.com/v1", model="gpt-4o-mini", proxy=None):
-        super().__init__(api_key, base_url, model)
-        self.header = header = {
-            "Authorization": f"Bearer {api_key}",
-        }
+        body = self.build_request_body(input_message, prompt, temperature=temperature, max_tokens=max_tokens)
+        return await self.post_chat_completion(body)
+
+
+class OpenAIChatAgent(PooledSessionAgent):
+    def __init__(self, api_key, base_url="https://api.openai.com/v1", model="gpt-4o-mini", proxy=None,
+                 **session_kwargs):
+        super().__init__(api_key, base_url, model, **session_kwargs)
         self.proxy = proxy
 
+    def build_request_body(self, input_message, prompt, temperature=0.5, max_tokens=4096) -> dict:
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": input_message}
+            ],
+            "temperature": temperature,
+            "max_completion_tokens": max_tokens,
+            "response_format": {"type": "json_object"}
+        }
+
     async def get_response(self, input_message, prompt, temperature=0.5, max_tokens=4096):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.base_url}/chat/completions", headers=self.header, json={
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": input_message}
-                ],
-                "temperature": temperature,
-                "max_completion_tokens": max_tokens,
-                "response_format": {"type": "json_object"}
-            }, proxy=self.proxy
-                                    ) as response:
-                if response.status != 200:
-                    logger.error(f"response status: {response.status}, response text: {await response.text()}")
-                    raise Exception(f"response status: {response.status}, response text: {await response.text()}")
-                result = await response.json()
-                return result["choices"][0]["message"]["content"]
+        body = self.build_request_body(input_message, prompt, temperature=temperature, max_tokens=max_tokens)
+        return await self.post_chat_completion(body, proxy=self.proxy)
@@ -0,0 +1,164 @@
+"""Provider batch API backends for the offline extraction mode of data_extract.py.
+
+A batch is an OpenAI-style JSONL file with one chat completion request per line::
+
+    {"custom_id": "...", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+
+and its output is a JSONL file with one ``{"custom_id", "response": {"status_code", "body"}, "error"}``
+object per request.
+"""
+
+import asyncio
+import json
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import aiofiles
+import aiohttp
+from loguru import logger
+
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+# OpenAI accepts at most 50,000 requests and 200 MB per batch input file; stay a little under the size limit
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1000 ** 2
+
+
+def build_batch_line(custom_id, body: dict, url="/v1/chat/completions") -> str:
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": url, "body": body}, ensure_ascii=False)
+
+
+def parse_output_line(line: str):
+    """Returns (custom_id, content, error) for one line of a batch output file."""
+    record = json.loads(line)
+    custom_id = record.get('custom_id')
+    response = record.get('response') or {}
+    if record.get('error') or response.get('status_code') != 200:
+        return custom_id, None, record.get('error') or response.get('body')
+    return custom_id, response['body']['choices'][0]['message']['content'], None
+
+
+class BatchBackend(ABC):
+    @abstractmethod
+    async def submit(self, input_path: Path) -> dict:
+        """Uploads and starts a batch; returns at least its 'id' and 'input_file_id'."""
+
+    @abstractmethod
+    async def status(self, batch_id: str) -> dict:
+        ...
+
+    @abstractmethod
+    async def download_output(self, batch_id: str, output_path: Path):
+        ...
+
+    async def wait(self, batch_id: str, poll_interval=60.0, timeout=None) -> dict:
+        started = time.monotonic()
+        while True:
+            status = await self.status(batch_id)
+            counts = status.get('request_counts') or {}
+            logger.info(f"batch {batch_id}: {status.get('status')}, {counts}")
+            if status.get('status') in FINAL_STATUSES:
+                return status
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise TimeoutError(f"batch {batch_id} did not finish within {timeout}s")
+            await asyncio.sleep(poll_interval)
+
+    async def close(self):
+        pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """Submits batches through the OpenAI Files and Batches endpoints, reusing the agent's pooled session."""
+
+    def __init__(self, agent, completion_window="24h"):
+        self.agent = agent
+        self.completion_window = completion_window
+
+    async def _request(self, method, path, **kwargs):
+        session = self.agent.get_session()
+        async with session.request(method, f"{self.agent.base_url}{path}", proxy=self.agent.proxy,
+                                   **kwargs) as response:
+            if response.status != 200:
+                raise Exception(f"response status: {response.status}, response text: {await response.text()}")
+            if response.content_type == 'application/json':
+                return await response.json()
+            return await response.read()
+
+    async def submit(self, input_path: Path) -> dict:
+        form = aiohttp.FormData()
+        form.add_field('purpose', 'batch')
+        form.add_field('file', input_path.read_bytes(), filename=input_path.name,
+                       content_type='application/jsonl')
+        uploaded = await self._request('POST', '/files', data=form)
+        batch = await self._request('POST', '/batches', json={
+            "input_file_id": uploaded['id'],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": self.completion_window,
+        })
+        return batch
+
+    async def status(self, batch_id: str) -> dict:
+        return await self._request('GET', f'/batches/{batch_id}')
+
+    async def download_output(self, batch_id: str, output_path: Path):
+        status = await self.status(batch_id)
+        async with aiofiles.open(output_path, 'wb') as f:
+            for file_id in (status.get('output_file_id'), status.get('error_file_id')):
+                if file_id:
+                    await f.write(await self._request('GET', f'/files/{file_id}/content'))
+
+
+class LocalBatchBackend(BatchBackend):
+    """File-based stand-in for a provider batch API.
+
+    Each submitted batch gets a directory under `root` holding `input.jsonl`. The batch
+    completes once `output.jsonl` appears next to it. With a `responder` (a sync or async
+    callable mapping a request body to the message content) the output is produced on
+    submit; without one, the output file has to be dropped in by hand or by a test.
+    """
+
+    def __init__(self, root, responder=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.responder = responder
+
+    async def submit(self, input_path: Path) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch_dir = self.root / batch_id
+        batch_dir.mkdir()
+        shutil.copyfile(input_path, batch_dir / 'input.jsonl')
+        if self.responder is not None:
+            await self._respond(batch_dir)
+        return {'id': batch_id, 'input_file_id': str(batch_dir / 'input.jsonl')}
+
+    async def _respond(self, batch_dir: Path):
+        lines = []
+        with open(batch_dir / 'input.jsonl', 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                content = self.responder(request['body'])
+                if asyncio.iscoroutine(content):
+                    content = await content
+                lines.append(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": request['custom_id'],
+                    "response": {"status_code": 200,
+                                 "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}},
+                    "error": None,
+                }, ensure_ascii=False))
+        (batch_dir / 'output.jsonl').write_text('\n'.join(lines) + '\n')
+
+    async def status(self, batch_id: str) -> dict:
+        batch_dir = self.root / batch_id
+        with open(batch_dir / 'input.jsonl', 'r') as f:
+            total = sum(1 for line in f if line.strip())
+        if (batch_dir / 'output.jsonl').exists():
+            return {'id': batch_id, 'status': 'completed', 'request_counts': {'total': total, 'completed': total}}
+        return {'id': batch_id, 'status': 'in_progress', 'request_counts': {'total': total, 'completed': 0}}
+
+    async def download_output(self, batch_id: str, output_path: Path):
+        shutil.copyfile(self.root / batch_id / 'output.jsonl', output_path)
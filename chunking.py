@@ -0,0 +1,121 @@
+"""Token estimates and map-reduce helpers for documents too long for one extraction request."""
+
+import re
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional, fall back to ~4 characters per token
+    tiktoken = None
+
+_encodings = {}
+_SENTENCE_END = re.compile(r'(?<=[.;:])\s+')
+
+
+def _get_encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("o200k_base")
+    return _encodings[model]
+
+
+def estimate_tokens(text: str, model="gpt-4o") -> int:
+    if not text:
+        return 0
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    return len(_get_encoding(model).encode(text, disallowed_special=()))
+
+
+def _split_oversized(block: str, max_tokens, model) -> list:
+    # A single block larger than a chunk (a huge table row or an unbroken paragraph) is cut on sentences, then words
+    pieces = []
+    current = []
+    current_tokens = 0
+    parts = _SENTENCE_END.split(block)
+    if len(parts) == 1:
+        parts = block.split(' ')
+    for part in parts:
+        part_tokens = estimate_tokens(part, model) + 1
+        if current and current_tokens + part_tokens > max_tokens:
+            pieces.append(' '.join(current))
+            current = []
+            current_tokens = 0
+        current.append(part)
+        current_tokens += part_tokens
+    if current:
+        pieces.append(' '.join(current))
+    return pieces
+
+
+def split_blocks(blocks: list, max_tokens: int, model="gpt-4o", header: str = None, with_tokens=False) -> list:
+    """Groups consecutive text blocks into chunks of at most `max_tokens`.
+
+    Chunks only break between blocks (paragraphs, table rows, list items), except for
+    blocks that are larger than a chunk by themselves. `header`, usually the title, is
+    prepended to every chunk after the first so each one still names the issuer. With
+    `with_tokens` the chunks are returned as (chunk, estimated tokens) pairs.
+    """
+    header_tokens = estimate_tokens(header, model) + 1 if header else 0
+    chunks = []
+    current = []
+    current_tokens = 0
+    for block in blocks:
+        block_tokens = estimate_tokens(block, model) + 1
+        budget = max_tokens - (header_tokens if chunks else 0)
+        pieces = [block] if block_tokens <= budget else _split_oversized(block, budget, model)
+        for piece in pieces:
+            piece_tokens = block_tokens if len(pieces) == 1 else estimate_tokens(piece, model) + 1
+            if current and current_tokens + piece_tokens > budget:
+                chunks.append((' '.join(current), current_tokens))
+                current = [header] if header else []
+                current_tokens = header_tokens
+                budget = max_tokens - header_tokens
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append((' '.join(current), current_tokens))
+    return chunks if with_tokens else [chunk for chunk, _ in chunks]
+
+
+def _is_true(value) -> bool:
+    return value is True or value == "True" or value == "true"
+
+
+def merge_extractions(results: list) -> list:
+    """Merges per-chunk extraction dicts into one dict per company, in order of first appearance."""
+    companies = {}
+    for result in results:
+        if not result:
+            continue
+        name = result.get('Company Name') or ''
+        key = ' '.join(name.lower().split())
+        merged = companies.get(key)
+        if merged is None:
+            merged = dict(result)
+            merged['Has New Rating'] = _is_true(result.get('Has New Rating'))
+            merged['Product Ratings'] = []
+            merged['_seen_products'] = set()
+            companies[key] = merged
+        else:
+            if _is_true(result.get('Has New Rating')):
+                merged['Has New Rating'] = True
+            for field in ('Company Name', 'Publication Date', 'Reason'):
+                if not merged.get(field) and result.get(field):
+                    merged[field] = result[field]
+        for product in result.get('Product Ratings') or []:
+            if not isinstance(product, dict):
+                continue
+            change = product.get('Rating Change') or {}
+            product_key = (product.get('Product Name'), change.get('Old Rating'), change.get('New Rating'))
+            if product_key not in merged['_seen_products']:
+                merged['_seen_products'].add(product_key)
+                merged['Product Ratings'].append(product)
+    merged_results = []
+    for merged in companies.values():
+        del merged['_seen_products']
+        if merged['Has New Rating']:
+            merged['Reason'] = ''
+        merged_results.append(merged)
+    return merged_results
@@ -0,0 +1,133 @@
+"""Vectorised fuzzy matching of extracted company names against MAST_ISSR issuer names.
+
+`CompanyIndex` normalises and token-sorts every issuer name once, then scores a whole batch
+of extracted names with rapidfuzz's multi-threaded `cdist`. Scores, ordering and ties are
+those of `fuzzywuzzy.process.extract(name, choices, scorer=fuzz.token_sort_ratio)`:
+`match` returns the same top-k (issuer_nam, score, mast_issr_num) tuples.
+"""
+
+import hashlib
+import pickle
+import re
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+from rapidfuzz import fuzz, process
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+def normalize_name(name) -> str:
+    """fuzzywuzzy's full_process: ASCII only, lower case, punctuation to spaces, trimmed."""
+    name = str(name).encode('ascii', 'ignore').decode('ascii').lower()
+    return _NON_ALNUM.sub(' ', name).strip()
+
+
+def sort_tokens(name) -> str:
+    return ' '.join(sorted(normalize_name(name).split()))
+
+
+def fingerprint(names: dict) -> str:
+    digest = hashlib.sha256()
+    for key, name in names.items():
+        digest.update(f'{key!r}\t{name!r}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class CompanyIndex:
+    def __init__(self, names: dict):
+        # mast_issr_num -> issuer_nam, in the order fuzzywuzzy would iterate the choices
+        self.keys = list(names.keys())
+        self.names = list(names.values())
+        self.sorted_names = [sort_tokens(name) for name in self.names]
+        self.fingerprint = fingerprint(names)
+        self._tokens = None
+
+    @classmethod
+    def load_or_build(cls, path, names: dict):
+        """Loads the index persisted at `path`, rebuilding it when the issuer names changed."""
+        path = Path(path)
+        if path.exists():
+            with open(path, 'rb') as f:
+                index = pickle.load(f)
+            if index.fingerprint == fingerprint(names):
+                return index
+            logger.info(f"Issuer names changed, rebuilding {path}")
+        index = cls(names)
+        index.save(path)
+        return index
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        return state
+
+    def _candidates(self, query: str):
+        # 分块：只比较至少有一个相同单词的发行人
+        if self._tokens is None:
+            self._tokens = {}
+            for position, name in enumerate(self.sorted_names):
+                for token in set(name.split()):
+                    self._tokens.setdefault(token, []).append(position)
+        positions = set()
+        for token in query.split():
+            positions.update(self._tokens.get(token, ()))
+        return np.array(sorted(positions), dtype=np.int64)
+
+    def _top(self, scores, positions, limit):
+        # fuzzywuzzy rounds scores to ints before ranking; a stable sort keeps ties in choice order
+        order = np.argsort(-scores, kind='stable')[:limit]
+        return [(self.names[positions[i]], int(scores[i]), self.keys[positions[i]]) for i in order]
+
+    def match(self, names, limit=5, blocking=False, chunk_size=256, workers=-1):
+        """Top `limit` (issuer_nam, score, mast_issr_num) for each name, in one batched call.
+
+        With `blocking`, only issuers sharing a word with the name are scored, which is much
+        faster on a large issuer table but can miss matches that only differ by typos.
+        """
+        queries = [sort_tokens(name) for name in names]
+        all_positions = np.arange(len(self.names))
+        results = []
+        if blocking:
+            for query in queries:
+                positions = self._candidates(query)
+                scores = process.cdist([query], [self.sorted_names[i] for i in positions], scorer=fuzz.ratio,
+                                       processor=None, workers=1)[0] if len(positions) else np.zeros(0)
+                results.append(self._top(np.rint(scores).astype(np.int32), positions, limit))
+            return results
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            scores = np.rint(process.cdist(chunk, self.sorted_names, scorer=fuzz.ratio, processor=None,
+                                           workers=workers)).astype(np.int32)
+            results.extend(self._top(row, all_positions, limit) for row in scores)
+        return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Build the issuer name index and time it against fuzzywuzzy.")
+    parser.add_argument('--mast-issr', default=Path('data') / 'MAST_ISSR.dta', type=Path)
+    parser.add_argument('--index-path', default=Path('data') / 'company_index.pkl', type=Path)
+    parser.add_argument('names', nargs='*')
+    args = parser.parse_args()
+    mast_issr_df = pd.read_stata(args.mast_issr)
+    issuer_names = mast_issr_df.set_index('mast_issr_num')['issuer_nam'].to_dict()
+    company_index = CompanyIndex.load_or_build(args.index_path, issuer_names)
+    queries = args.names or list(issuer_names.values())[:200]
+    started = time.perf_counter()
+    matches = company_index.match(queries, limit=2)
+    elapsed = time.perf_counter() - started
+    logger.info(f"Matched {len(queries)} names against {len(issuer_names)} issuers in {elapsed:.2f}s")
+    for query, match in zip(queries, matches):
+        print(query, match)
@@ -1,16 +1,29 @@
 from pathlib import Path
 import json
 import aiofiles
-import re
 import asyncio
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from loguru import logger
-import copy
 from Agent import ZhiPuAgent, MoonshotAgent, OpenAIChatAgent
 import os
 from asyncio import Queue
-from utli import try_parse_json_object
+from utli import parse_json, parse_stats
+from html_cleaner import clean_detail
+from scheduler import RateLimitScheduler
+from chunking import estimate_tokens, split_blocks, merge_extractions
+from batch_extract import (BatchBackend, OpenAIBatchBackend, LocalBatchBackend, build_batch_line, parse_output_line,
+                           MAX_BATCH_REQUESTS, MAX_BATCH_BYTES)
+from llm_cache import ResponseCache
+from ledger import WorkLedger, PENDING, VALID, INVALID
+from prefilter import PreFilter
+from publications.detail_store import DetailStore
+from rating_rules import extract_rating_changes
+from results_store import ResultStore, PROCESSED
+from records import RecordError, parse_extraction, result_fields, detail_reference
 moonshot_api_key = os.getenv("MOONSHOT_API_KEY")
 openai_api_key = os.getenv("OPENAI_API_KEY")
 zhipu_api_key = os.getenv("ZHIPU_API_KEY")
@@ -21,6 +34,32 @@ longer_moonshot_agent = MoonshotAgent(api_key=moonshot_api_key,
 proxy = None
 openai_agent = OpenAIChatAgent(api_key=openai_api_key, model="gpt-4o",
                                proxy=proxy)
+openai_scheduler = RateLimitScheduler(requests_per_minute=int(os.getenv("OPENAI_RPM", "500")),
+                                      tokens_per_minute=int(os.getenv("OPENAI_TPM", "300000")))
+moonshot_scheduler = RateLimitScheduler(requests_per_minute=int(os.getenv("MOONSHOT_RPM", "200")),
+                                        tokens_per_minute=int(os.getenv("MOONSHOT_TPM", "128000")))
+# (agent, scheduler, context window in tokens), in order of preference
+agent_routes = [
+    (openai_agent, openai_scheduler, 128000),
+    (longer_moonshot_agent, moonshot_scheduler, 32000),
+]
+# Documents estimated above this many tokens are split into chunks and extracted map-reduce style
+chunk_tokens = int(os.getenv("EXTRACT_CHUNK_TOKENS", "12000"))
+dead_letter_path = Path('data') / 'dead_letter.json'
+pre_filter = PreFilter.load(Path('data') / 'prefilter_model.pkl')
+prefilter_threshold = None  # Documents scoring below this are not sent to the LLM; None disables the pre-filter
+# Rule-based results at or above this confidence replace the LLM call; 1.0 takes only extractions that pass
+# every check. `python rating_rules.py` reports precision per threshold against the LLM labels, above 1 disables it
+rule_confidence_threshold = 1.0
+ledger = WorkLedger(Path('data') / 'ledger.sqlite')
+detail_store = DetailStore(Path('data') / 'store')  # Documents crawled into segments; loose detail files still work
+results_store = ResultStore(Path('data') / 'results.sqlite')  # processed results, queried instead of globbed
+streamed_details = {}  # publication_id -> detail JSON handed over by the crawler in streaming mode, until processed
+extract_before_year = 2005  # Only documents published before this year are extracted
+usage_tokens = {}  # publication_id -> estimated tokens sent to the API for it during this run
+request_schedulers = {}  # publication_id -> scheduler of the route its last request went to
+response_cache = ResponseCache(Path('data') / 'llm_cache.sqlite',
+                               max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(2 * 1024 ** 3))))
 prompt = r"""
 ### Task Overview:
 You are a financial analyst with expertise in data processing. Your task is to extract company-related **downgrade** information from provided HTML content. Specifically, extract details such as the **company name**, **publication date**, **product names**, and the corresponding **rating changes**. If a company has multiple products, list them accordingly. Subsidiaries should be grouped under their parent company.
@@ -82,6 +121,7 @@ You are a financial analyst with expertise in data processing. Your task is to e
 clean_json_prompt = """
 Please output a valid JSON object with can be transfer with json.loads() function.
 """
+prompt_tokens = estimate_tokens(prompt)
 un_process_words = ['POSSIBLE DOWNGRADE', 'POSSIBLE FURTHER DOWNGRADE', 'POSSIBLE UPGRADE', 'POSSIBLE FURTHER UPGRADE',
                     'POSSIBLE STABLE', 'POSSIBLE FURTHER STABLE', 'POSSIBLE WATCH', 'POSSIBLE FURTHER WATCH',
                     'POSSIBLE REVIEW', 'POSSIBLE FURTHER REVIEW', 'POSSIBLE PLACEMENT', 'POSSIBLE FURTHER PLACEMENT',
@@ -95,102 +135,200 @@ un_process_words = ['POSSIBLE DOWNGRADE', 'POSSIBLE FURTHER DOWNGRADE', 'POSSIBL
                     ]  # List of words to check for downgrade information
 
 
+async def get_llm_response(agent, scheduler: RateLimitScheduler, input_message, prompt, temperature=0.0,
+                           max_tokens=4096, usage_key=None, input_tokens=None):
+    # Identical (model, prompt, temperature, input) requests are answered from the on-disk cache
+    cached = response_cache.get(agent.model, prompt, temperature, input_message)
+    if cached is not None:
+        return cached
+    if input_tokens is None:
+        input_tokens = estimate_tokens(input_message, agent.model)
+    str_result = await scheduler.get_response(agent, input_message=input_message, prompt=prompt,
+                                              temperature=temperature, max_tokens=max_tokens,
+                                              tokens=input_tokens + prompt_tokens + max_tokens)
+    response_cache.put(agent.model, prompt, temperature, input_message, str_result)
+    if usage_key is not None:
+        usage_tokens[usage_key] = (usage_tokens.get(usage_key, 0) + input_tokens + prompt_tokens
+                                   + estimate_tokens(str_result, agent.model))
+    return str_result
+
+
+cpu_executor = None  # ProcessPoolExecutor for CPU-bound stages, set by main(); None runs them on the event loop
+throughput = {'documents': 0, 'clean_seconds': 0.0, 'parse_seconds': 0.0}
+
+
+async def run_cpu(func, *args):
+    if cpu_executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, func, *args)
+
+
+def route_request(total_tokens):
+    """Returns the first (agent, scheduler) in agent_routes whose context window fits `total_tokens`."""
+    for agent, scheduler, context_window in agent_routes:
+        if total_tokens <= context_window:
+            return agent, scheduler
+    return None
+
+
+def output_budget(input_tokens):
+    # Short documents rarely list more than a few ratings; long rating lists need the larger output budget
+    return 4096 if input_tokens < 1024 else 4096 * 4
+
+
+async def extract_document(detail_file: Path, input_message, input_tokens) -> dict:
+    max_tokens = output_budget(input_tokens)
+    route = route_request(prompt_tokens + input_tokens + max_tokens)
+    if route is None:
+        raise Exception(f"exceeded model token limit: ~{input_tokens} input tokens")
+    agent, scheduler = route
+    request_schedulers[detail_file.stem] = scheduler
+    str_result = await get_llm_response(agent, scheduler, input_message, prompt, temperature=0.0,
+                                        max_tokens=max_tokens, usage_key=detail_file.stem, input_tokens=input_tokens)
+    logger.info(
+        f"file name: {detail_file.name},model: {agent.model},json_result: {str_result},input_message_length: {len(input_message)},output_message_length: {len(str_result)}")
+    try:
+        return await parse_llm_json(str_result)
+    except ValueError:
+        # 解析不了的回答不能留在缓存里，否则重试只会重放同一个回答
+        response_cache.delete(agent.model, prompt, 0.0, input_message)
+        raise
+
+
+async def parse_llm_json(text) -> dict:
+    """Parses a model response; raises ValueError when it holds no JSON object (refusals, truncated output)."""
+    # 解析在工作进程中进行时，各阶段的计数在主进程里汇总
+    start = time.perf_counter()
+    _, json_result, stage = await run_cpu(parse_json, text)
+    throughput['parse_seconds'] += time.perf_counter() - start
+    parse_stats[stage] += 1
+    if stage == 'failed':
+        raise ValueError(f"no JSON object in the model response: {text[:200]!r}")
+    return json_result
+
+
+async def extract_in_chunks(detail_file: Path, blocks, title) -> dict:
+    """Map-reduce extraction: every chunk is extracted concurrently, results are merged per company.
+
+    The document title is repeated at the top of every chunk after the first so each one names the issuer.
+    """
+    header = title.lower() if title and estimate_tokens(title) < chunk_tokens // 4 else None
+    chunks = split_blocks(blocks, chunk_tokens, openai_agent.model, header=header, with_tokens=True)
+    chunk_results = await asyncio.gather(*[
+        extract_document(detail_file, chunk, chunk_token_count) for chunk, chunk_token_count in chunks
+    ])
+    companies = merge_extractions(chunk_results)
+    logger.info(f"file: {detail_file.name} extracted from {len(chunks)} chunks, {len(companies)} companies found")
+    if not companies:
+        return {}
+    json_result = dict(companies[0])
+    if len(companies) > 1:
+        json_result['Companies'] = companies
+        json_result['Has New Rating'] = any(company['Has New Rating'] for company in companies)
+    return json_result
+
+
+async def prepare_detail_file(detail_file: Path):
+    """Reads and cleans a detail file.
+
+    Returns (detail, result). `result` already carries an InvalidReason when the document
+    does not need to be sent to the LLM.
+    """
+    raw_detail = streamed_details.get(detail_file.stem)
+    if raw_detail is None:
+        raw_detail = detail_store.get_raw(detail_file.stem)
+    if raw_detail is None:
+        async with aiofiles.open(detail_file, 'r') as f:
+            raw_detail = await f.read()
+    result = {}
+    # 去除<head>/<script>/<style>、html标签和多余空白，只保留小写的可见文本
+    start = time.perf_counter()
+    detail = await run_cpu(clean_detail, raw_detail, openai_agent.model)
+    throughput['clean_seconds'] += time.perf_counter() - start
+    if not detail['has_research_payload']:
+        result['InvalidReason'] = "No researchPayload found in the JSON content."
+        return detail, result
+    html_content = detail['text']
+    # Check for downgrade information in a case-insensitive way
+    html_has_upgrade = 'upgrade' in html_content
+    html_has_downgrade = 'downgrade' in html_content
+    result['title'] = detail['title']
+    result['report_publish_date'] = detail['report_publish_date']
+    # 原文不再复制进结果，按publication_id到detail store/corpus取
+    result['detail_ref'] = detail_reference(detail_file)
+    if not (html_has_upgrade or html_has_downgrade):
+        logger.info(f"No downgrade information found in {detail_file.name}")
+        result['InvalidReason'] = "No downgrade information found in the HTML content."
+    elif prefilter_threshold is not None:
+        score = pre_filter.score(html_content)
+        result['PrefilterScore'] = score
+        if score < prefilter_threshold:
+            logger.info(f"Pre-filter score {score:.2f} of {detail_file.name} is below {prefilter_threshold}")
+            result['InvalidReason'] = "Pre-filter score below threshold, no confirmed rating change expected."
+    return detail, result
+
+
+def try_rule_extraction(detail_file: Path, detail: dict):
+    """Returns the rule-based extraction result when it is confident enough to skip the LLM, else None."""
+    rule_result, confidence = extract_rating_changes(detail['text'], detail['title'], detail['report_publish_date'])
+    if confidence < rule_confidence_threshold:
+        return None
+    logger.info(f"file: {detail_file.name} extracted by rules with confidence {confidence:.2f}")
+    rule_result['Extractor'] = 'rules'
+    rule_result['RuleConfidence'] = confidence
+    return rule_result
+
+
+def apply_extraction(detail_file: Path, result: dict, json_result: dict) -> bool:
+    """Validates the model output into typed records, writes them into `result` and returns
+    whether any company reports a new rating."""
+    try:
+        companies = parse_extraction(json_result)
+    except RecordError as e:
+        logger.warning(f"Invalid extraction result for {detail_file.name}: {e}")
+        result['InvalidReason'] = "LLM model returned a result that does not match the schema: " + str(e)
+        return False
+    downgrade = any(company.has_new_rating for company in companies)
+    if downgrade:
+        logger.info(f"Downgrade information found in {detail_file.name}")
+    else:
+        logger.info(f"No downgrade information found in {detail_file.name}")
+        result['InvalidReason'] = "LLM model can't find downgrade information."
+    result.update(result_fields(companies, json_result))
+    return downgrade
+
+
 async def process_detail_file(detail_file: Path):
-    async with aiofiles.open(detail_file, 'r') as f:
-        data = json.loads(await f.read())
-    # Check for downgrade information in a case-insensitive way in the researchPayload content
     downgrade = False
     is_error = False
-    has_research_payload = False
-    result = {}
-    if 'researchPayload' in data:
-        has_research_payload = True
-        html_content = data['researchPayload'].get('html_content', '').lower()  # Convert content to lowercase
-        # Published date
-        report_publish_date = data['baseInfo'][0].get('published_date', None)
-        title = data['baseInfo'][0].get('title', None)
-        # Check for downgrade information in a case-insensitive way
-
-        # if title is not None:
-        #     uppercase_title = title.upper()
-        #     for word in un_process_words:
-        #         if word in uppercase_title:
-        #             downgrade = True
-        #             break
-        # 使用正则表达式过滤html_content中的标签
-        # 1. 去除<head>标签及其内容
-        html_content = re.sub(r'<html.*</head>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        # 2. 去除<script>标签及其内容
-        html_content = re.sub(r'<script.*</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        html_content = re.sub(r'"', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        # 2. 去除无用的换行和空格
-        save_html_content = copy.deepcopy(html_content)
-        html_content = re.sub(r'[\n|\r|"]', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        html_content = re.sub(r'\s+', ' ', html_content, flags=re.DOTALL | re.IGNORECASE)
-        # 3. 去除所有html标签
-        html_content = re.sub(r'<[^>]+>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        html_has_upgrade = 'upgrade' in html_content.lower()
-        html_has_downgrade = 'downgrade' in html_content.lower()
-        result['title'] = title
-        result['report_publish_date'] = report_publish_date
-        result['html_content'] = save_html_content
-        if not (html_has_upgrade or html_has_downgrade):
-            logger.info(f"No downgrade information found in {detail_file.name}")
-            result['InvalidReason'] = "No downgrade information found in the HTML content."
-        else:
-            # 使用大模型进行预测
-            # 1. 加载模型
-            try:
+    detail, result = await prepare_detail_file(detail_file)
+    has_research_payload = detail['has_research_payload']
+    if has_research_payload and 'InvalidReason' not in result:
+        # 使用大模型进行预测
+        html_content = detail['text']
+        try:
+            input_tokens = detail['tokens']
+            rule_result = try_rule_extraction(detail_file, detail)
+            if rule_result is not None:
+                json_result = rule_result
+            elif input_tokens > chunk_tokens:
+                logger.info(f"file: {detail_file.name} has ~{input_tokens} tokens, extracting in chunks")
+                json_result = await extract_in_chunks(detail_file, detail['blocks'], detail['title'])
+            else:
                 try:
-                    if len(html_content) < 4096:
-                        str_result = await openai_agent.get_response(input_message=html_content, prompt=prompt,
-                                                                     temperature=0.0, max_tokens=4096)
-                        # str_result = await moonshot_agent.get_response(input_message=html_content, prompt=prompt,
-                        #                                              temperature=0.0, max_tokens=4096)
-                    else:
-                        str_result = await openai_agent.get_response(input_message=html_content, prompt=prompt,
-                                                                     temperature=0.0, max_tokens=4096 * 4)
-                        # str_result = await longer_moonshot_agent.get_response(input_message=html_content, prompt=prompt,
-                        #                                              temperature=0.0, max_tokens=4096 * 4)
+                    json_result = await extract_document(detail_file, html_content, input_tokens)
                 except Exception as e:
-                    if 'exceeded model token limit' in str(e):
-                        logger.warning(
-                            f"file: {detail_file} Exceeded model token limit, trying with longer model. the input message length is {len(html_content)}")
-                        str_result = await longer_moonshot_agent.get_response(input_message=html_content, prompt=prompt,
-                                                                              temperature=0.0, max_tokens=4096 * 4)
-                    else:
+                    if 'exceeded model token limit' not in str(e) and 'context_length_exceeded' not in str(e):
                         logger.warning(f"Error processing {detail_file.name}: {e}")
                         raise e
-                str_result = re.sub(r'', '', str_result)
-                # str_result = str_result.replace(r'\"', '')
-                # try:
-                logger.info(
-                    f"file name: {detail_file.name},json_result: {str_result},input_message_length: {len(html_content)},output_message_length: {len(str_result)}")
-                _, json_result = try_parse_json_object(str_result)
-                # except:
-                #     logger.warning("Error decoding faulty json, attempting repair")
-                #     logger.info(f"file name: {detail_file.name},str_result: {str_result}")
-                #     clean_str_result = zhipu_agent.get_response(input_message=str_result,
-                #                                                 prompt=clean_json_prompt,
-                #                                                 temperature=0.0)
-                #     _, json_result = try_parse_json_object(clean_str_result)
-                # 2. 处理预测结果
-                has_new_rating = json_result.get('Has New Rating', "False")
-                if has_new_rating == "True" or has_new_rating is True:
-                    downgrade = True
-                if downgrade:
-                    logger.info(f"Downgrade information found in {detail_file.name}")
-                else:
-                    logger.info(f"No downgrade information found in {detail_file.name}")
-                    result['InvalidReason'] = "LLM model can't find downgrade information."
-                for key, value in json_result.items():
-                    result[key] = value
-            except Exception as e:
-                is_error = True
-                logger.error(f"Error processing {detail_file.name}: {e}")
-                result['InvalidReason'] = "Request to LLM model failed, the error message is: " + str(e)
-    else:
-        result['InvalidReason'] = "No researchPayload found in the JSON content."
+                    logger.warning(f"file: {detail_file} exceeded model token limit, extracting in chunks")
+                    json_result = await extract_in_chunks(detail_file, detail['blocks'], detail['title'])
+            # 处理预测结果
+            downgrade = apply_extraction(detail_file, result, json_result)
+        except Exception as e:
+            is_error = True
+            logger.error(f"Error processing {detail_file.name}: {e}")
+            result['InvalidReason'] = "Request to LLM model failed, the error message is: " + str(e)
     return result, downgrade, is_error, has_research_payload
 
 
@@ -199,70 +337,400 @@ async def save_json_file(file_path, data):
         await f.write(json.dumps(data, indent=2))
 
 
-async def producer(queue: Queue):
+def iter_pending_files():
     data_path = Path('data')
-    for year_data_path in data_path.iterdir():
-        year = int(year_data_path.name)
-        if year >= 2005:
+    ledger.sync_store(detail_store, data_path)
+    years = {int(path.name) for path in data_path.iterdir() if path.name.isdigit()} | set(detail_store.years())
+    for year in sorted(years):
+        year_data_path = data_path / str(year)
+        if year >= extract_before_year:
             continue
         logger.info(f"Processing {year_data_path}")
-        detail_data_path = year_data_path / 'detail'
-        if detail_data_path.exists():
-            detail_files = list(detail_data_path.glob('*.json'))
-            processed_data_path = year_data_path / 'processed'
-            processed_data_valid_path = processed_data_path / 'valid'
-            processed_data_invalid_path = processed_data_path / 'invalid'
-            processed_data_valid_path.mkdir(parents=True, exist_ok=True)
-            processed_data_invalid_path.mkdir(parents=True, exist_ok=True)
-            for detail_file in detail_files:
-                processed_file_valid_path = processed_data_valid_path / detail_file.name
-                processed_file_invalid_path = processed_data_invalid_path / detail_file.name
-                if processed_file_valid_path.exists() or processed_file_invalid_path.exists():
-                    logger.info(f"File {detail_file.name} already processed. Skipping...")
-                    continue
-                await queue.put((detail_file, processed_file_valid_path, processed_file_invalid_path))
+        ledger.sync_year(year, year_data_path)
+        for publication_id, detail_path in ledger.iter_pending(year):
+            yield Path(detail_path), year
 
 
-async def consumer(queue: Queue):
-    while True:
-        detail_file, processed_file_valid_path, processed_file_invalid_path = await queue.get()
-        logger.info(f"Processing {detail_file.name}")
-        result, downgrade, is_error, has_research_payload = await process_detail_file(detail_file)
-        if has_research_payload:
-            if not is_error:
-                if not downgrade:  # If no downgrade information is found, skip
-                    processed_file = processed_file_invalid_path
-                else:
-                    processed_file = processed_file_valid_path
-                await save_json_file(processed_file, result)
-                logger.info(f"File {detail_file.name} processed successfully., saved to {processed_file}")
-                await asyncio.sleep(0.2)  # Simulate I/O bound operation
-            else:
-                queue.put_nowait((detail_file, processed_file_valid_path, processed_file_invalid_path))
+async def producer(queue: Queue):
+    for item in iter_pending_files():
+        await queue.put(item)
+
+
+async def requeue_later(queue: Queue, item, delay):
+    # The original get() stays unfinished until the retry is back in the queue, so queue.join() keeps waiting
+    await asyncio.sleep(delay)
+    await queue.put(item)
+    queue.task_done()
+
+
+async def handle_item(queue: Queue, item, retry_tasks: set) -> bool:
+    """Processes one queued file; returns True when it was scheduled for a retry and stays unfinished."""
+    detail_file = item[0]
+    publication_id = detail_file.stem
+    logger.info(f"Processing {detail_file.name}")
+    ledger.mark_in_flight(publication_id)
+    result, downgrade, is_error, has_research_payload = await process_detail_file(detail_file)
+    throughput['documents'] += 1
+    # 成功/失败记在实际使用的路由上；没有发出请求的文件记在首选路由上
+    scheduler = request_schedulers.pop(publication_id, openai_scheduler)
+    if has_research_payload:
+        if not is_error:
+            scheduler.record_success(str(detail_file))
+            await save_processed(item, result, downgrade)
         else:
-            logger.info(f"File {detail_file.name} has no researchPayload. Skipping...")
-        queue.task_done()
+            error = result.get('InvalidReason')
+            cost = usage_tokens.pop(publication_id, 0)
+            delay = scheduler.record_failure(str(detail_file), error)
+            if delay is None:
+                logger.error(f"File {detail_file.name} failed too many times, moved to dead letter.")
+                ledger.mark_error(publication_id, error, cost=cost)
+            else:
+                logger.warning(f"File {detail_file.name} failed, retrying in {delay:.1f}s")
+                ledger.mark_retry(publication_id, error, cost=cost)
+                task = asyncio.create_task(requeue_later(queue, item, delay))
+                retry_tasks.add(task)
+                task.add_done_callback(retry_tasks.discard)
+                return True
+    else:
+        logger.info(f"File {detail_file.name} has no researchPayload. Skipping...")
+        ledger.mark_done(publication_id, INVALID, error=result.get('InvalidReason'))
+    return False
 
 
-async def main():
-    queue = asyncio.Queue()
+async def consumer(queue: Queue, retry_tasks: set):
+    while True:
+        item = await queue.get()
+        if item is None:  # Shutdown sentinel
+            queue.task_done()
+            return
+        publication_id = item[0].stem
+        try:
+            requeued = await handle_item(queue, item, retry_tasks)
+        except Exception as e:
+            # 例如损坏的详情文件：记一次失败，留给下次运行，consumer继续处理后面的文件
+            logger.error(f"Error processing {item[0].name}: {e!r}")
+            request_schedulers.pop(publication_id, None)
+            ledger.mark_failed(publication_id, repr(e), openai_scheduler.max_file_attempts,
+                               cost=usage_tokens.pop(publication_id, 0))
+            requeued = False
+        if not requeued:
+            streamed_details.pop(publication_id, None)
+            queue.task_done()
+
+
+def log_throughput(mode, elapsed):
+    documents = throughput['documents']
+    logger.info(f"[{mode}] processed {documents} documents in {elapsed:.1f}s "
+                f"({documents / elapsed if elapsed else 0.0:.2f} docs/s), "
+                f"cleaning wall time {throughput['clean_seconds']:.1f}s, "
+                f"json parsing wall time {throughput['parse_seconds']:.1f}s, "
+                f"json parse stages {dict(parse_stats)}")
+
+
+async def main(cpu_workers=0, batch_backend: BatchBackend = None, batch_size=MAX_BATCH_REQUESTS,
+               batch_max_bytes=MAX_BATCH_BYTES, poll_interval=60.0, retry_errors=False, consumers=10, queue_depth=100,
+               min_prefilter_score=None, min_rule_confidence=1.0):
+    global cpu_executor, prefilter_threshold, rule_confidence_threshold
+    prefilter_threshold = min_prefilter_score
+    rule_confidence_threshold = min_rule_confidence
+    ledger.reset_in_flight()
+    if retry_errors:
+        logger.info(f"Ledger: {ledger.retry_errors()} failed jobs reset to pending")
+    if cpu_workers > 0:
+        cpu_executor = ProcessPoolExecutor(max_workers=cpu_workers)
+    mode = f"process-pool[{cpu_workers}]" if cpu_executor is not None else "inline"
+    started = time.perf_counter()
+    if batch_backend is not None:
+        await run_batch(batch_backend, batch_size=batch_size, max_bytes=batch_max_bytes, poll_interval=poll_interval)
+        await batch_backend.close()
+        await shutdown(f"batch/{mode}", started)
+        return
+    openai_agent.connection_limit = max(openai_agent.connection_limit, consumers)
+    await run_live(consumers, queue_depth)
+    await shutdown(mode, started)
+
+
+async def run_live(consumers=10, queue_depth=100):
+    """Runs the producer and `consumers` consumers over a queue holding at most `queue_depth` files.
+
+    On SIGINT/SIGTERM the producer stops, queued files are left pending in the ledger and
+    every consumer finishes and saves the file it is working on before exiting. A second
+    signal falls back to the default handler.
+    """
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+
+    def request_stop(sig):
+        logger.warning(f"Received {sig.name}, finishing in-flight files before exiting. Repeat to force quit.")
+        stop_event.set()
+        for handled_sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(handled_sig)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_stop, sig)
+        except NotImplementedError:  # Windows event loops have no signal handlers
+            pass
+
+    queue = asyncio.Queue(maxsize=queue_depth)
     producer_task = asyncio.create_task(producer(queue))
-    consumer_tasks = [asyncio.create_task(consumer(queue)) for _ in range(10)]  # create 5 consumers
+    retry_tasks = set()
+    consumer_tasks = [asyncio.create_task(consumer(queue, retry_tasks)) for _ in range(consumers)]
+    stop_task = asyncio.create_task(stop_event.wait())
     logger.info("Waiting for all items in the queue to be processed...")
-    await producer_task
-    logger.info("Producer task completed.")
-    await queue.join()  # Wait for all items in the queue to be processed
-    for task in consumer_tasks:
-        task.cancel()
-    logger.info("All items in the queue have been processed.")
+    await asyncio.wait({producer_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+    if not stop_event.is_set():
+        logger.info("Producer task completed.")
+        join_task = asyncio.create_task(queue.join())  # Wait for all items in the queue to be processed
+        await asyncio.wait({join_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        join_task.cancel()
+    if stop_event.is_set():
+        producer_task.cancel()
+        for task in list(retry_tasks):
+            task.cancel()
+        drained = 0
+        while not queue.empty():
+            queue.get_nowait()
+            queue.task_done()
+            drained += 1
+        logger.info(f"{drained} queued files left pending for the next run.")
+    else:
+        logger.info("All items in the queue have been processed.")
+    stop_task.cancel()
+    for _ in consumer_tasks:
+        await queue.put(None)
+    await asyncio.gather(*consumer_tasks)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.remove_signal_handler(sig)
+        except NotImplementedError:
+            pass
+
+
+async def shutdown(mode, started):
+    global cpu_executor
+    log_throughput(mode, time.perf_counter() - started)
+    if cpu_executor is not None:
+        cpu_executor.shutdown()
+        cpu_executor = None
+    dead_letter = {}
+    for scheduler in (openai_scheduler, moonshot_scheduler):
+        dead_letter.update(scheduler.dead_letter)
+    if dead_letter:
+        logger.warning(f"{len(dead_letter)} files moved to dead letter, see {dead_letter_path}")
+        await save_json_file(dead_letter_path, dead_letter)
+    logger.info(f"LLM response cache: {response_cache.stats()}")
+    response_cache.close()
+    logger.info(f"Ledger: {ledger.counts()}")
+    ledger.close()
+    logger.info(f"Results: {results_store.counts(PROCESSED)}")
+    results_store.close()
+    detail_store.close()
+    for agent in (openai_agent, moonshot_agent, longer_moonshot_agent):
+        await agent.close()
+
+
+async def save_processed(item, result, downgrade):
+    detail_file, year = item
+    label = VALID if downgrade else INVALID
+    results_store.append(PROCESSED, label, detail_file.stem, year, result)
+    ledger.mark_done(detail_file.stem, VALID if downgrade else INVALID, cost=usage_tokens.pop(detail_file.stem, 0),
+                     error=result.get('InvalidReason'))
+    logger.info(f"File {detail_file.name} processed successfully., stored as {label}")
+
+
+async def run_batch(backend: BatchBackend, batch_size=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES,
+                    poll_interval=60.0):
+    """Extracts every pending detail file through a provider batch API instead of live requests.
+
+    Documents that fail the cheap gates, hit the response cache or need chunking are
+    handled directly; the rest are written as batch JSONL, submitted once a file holds
+    `batch_size` requests or would grow past `max_bytes`, and their outputs fanned back
+    into the results store.
+    """
+    batch_path = Path('data') / 'batches'
+    batch_path.mkdir(parents=True, exist_ok=True)
+    agent = openai_agent
+    max_tokens = 4096 * 4
+    pending = {}  # custom_id -> (item, prepared result, input_message, batch line)
+    pending_bytes = 0
+
+    def record_failure(item, error):
+        exhausted = ledger.mark_failed(item[0].stem, str(error), openai_scheduler.max_file_attempts)
+        if exhausted:
+            logger.error(f"batch request for {item[0].name} failed too many times: {error}")
+        else:
+            logger.warning(f"batch request for {item[0].name} failed, it stays pending for the next run: {error}")
+
+    async def collect(batch_id, input_path: Path, requests: dict):
+        """Waits for a submitted batch and saves the outputs of `requests` (custom_id -> (item, result, input))."""
+        status = await backend.wait(batch_id, poll_interval=poll_interval)
+        if status.get('status') != 'completed':
+            logger.error(f"batch {batch_id} ended with status {status.get('status')}")
+            for item, _, _ in requests.values():
+                record_failure(item, f"batch {batch_id} ended with status {status.get('status')}")
+        else:
+            output_path = input_path.with_suffix('.output.jsonl')
+            await backend.download_output(batch_id, output_path)
+            async with aiofiles.open(output_path, 'r') as f:
+                lines = await f.readlines()
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    custom_id, content, error = parse_output_line(line)
+                except Exception as e:
+                    # Its request, if any, is failed below with the others that got no output line
+                    logger.error(f"unreadable output line in batch {batch_id}: {e}, line={line.strip()[:200]}")
+                    continue
+                if custom_id not in requests:
+                    continue
+                item, result, input_message = requests.pop(custom_id)
+                if error is not None:
+                    record_failure(item, error)
+                    continue
+                try:
+                    json_result = await parse_llm_json(content)
+                    downgrade = apply_extraction(item[0], result, json_result)
+                except Exception as e:
+                    record_failure(item, f"could not parse batch output: {e}")
+                    continue
+                response_cache.put(agent.model, prompt, 0.0, input_message, content)
+                await save_processed(item, result, downgrade)
+                throughput['documents'] += 1
+            for item, _, _ in requests.values():
+                record_failure(item, f"no output line in batch {batch_id}")
+        ledger.finish_batch(batch_id, status.get('status'))
+
+    async def flush():
+        nonlocal pending_bytes
+        if not pending:
+            return
+        input_path = batch_path / f"batch-{int(time.time())}-{len(pending)}.jsonl"
+        async with aiofiles.open(input_path, 'w') as f:
+            for _, _, _, line in pending.values():
+                await f.write(line)
+        batch = await backend.submit(input_path)
+        # 先记下batch id，中断后下次启动继续等待这个batch，不再重复提交
+        ledger.add_batch(batch['id'], batch.get('input_file_id'), input_path)
+        logger.info(f"Submitted {len(pending)} requests from {input_path} as {batch['id']}")
+        requests = {custom_id: (item, result, input_message)
+                    for custom_id, (item, result, input_message, _) in pending.items()}
+        pending.clear()
+        pending_bytes = 0
+        await collect(batch['id'], input_path, requests)
+
+    # Batches submitted by an interrupted run are collected before anything is submitted again
+    for batch_id, input_path in ledger.open_batches():
+        input_path = Path(input_path)
+        requests = {}
+        if input_path.exists():
+            with open(input_path, 'r') as f:
+                custom_ids = [json.loads(line)['custom_id'] for line in f if line.strip()]
+        else:
+            logger.warning(f"input file {input_path} of batch {batch_id} is gone, its requests stay pending")
+            custom_ids = []
+        for custom_id in custom_ids:
+            job = ledger.job(Path(custom_id).stem)
+            if job is None or job[2] != PENDING:
+                continue
+            try:
+                detail, result = await prepare_detail_file(Path(custom_id))
+            except Exception as e:
+                record_failure((Path(custom_id), job[1]), repr(e))
+                continue
+            requests[custom_id] = ((Path(custom_id), job[1]), result, detail.get('text'))
+        logger.info(f"Resuming batch {batch_id} submitted by an earlier run, {len(requests)} requests pending")
+        await collect(batch_id, input_path, requests)
+
+    for item in iter_pending_files():
+        detail_file = item[0]
+        try:
+            detail, result = await prepare_detail_file(detail_file)
+        except Exception as e:
+            record_failure(item, repr(e))
+            continue
+        if not detail['has_research_payload']:
+            logger.info(f"File {detail_file.name} has no researchPayload. Skipping...")
+            ledger.mark_done(detail_file.stem, INVALID, error=result.get('InvalidReason'))
+            continue
+        if 'InvalidReason' in result:
+            await save_processed(item, result, False)
+            continue
+        input_message = detail['text']
+        rule_result = try_rule_extraction(detail_file, detail)
+        if rule_result is not None:
+            await save_processed(item, result, apply_extraction(detail_file, result, rule_result))
+            continue
+        cached = response_cache.get(agent.model, prompt, 0.0, input_message)
+        if cached is not None:
+            try:
+                json_result = await parse_llm_json(cached)
+                downgrade = apply_extraction(detail_file, result, json_result)
+            except Exception as e:
+                response_cache.delete(agent.model, prompt, 0.0, input_message)
+                record_failure(item, f"could not parse cached response: {e}")
+                continue
+            await save_processed(item, result, downgrade)
+        elif detail['tokens'] > chunk_tokens:
+            # Chunked documents are merged per company, which needs all chunks back at once; keep them live
+            result, downgrade, is_error, _ = await process_detail_file(detail_file)
+            request_schedulers.pop(detail_file.stem, None)
+            if not is_error:
+                await save_processed(item, result, downgrade)
+        else:
+            custom_id = str(detail_file)
+            body = agent.build_request_body(input_message, prompt, temperature=0.0, max_tokens=max_tokens)
+            line = build_batch_line(custom_id, body) + '\n'
+            line_bytes = len(line.encode('utf-8'))
+            if pending and pending_bytes + line_bytes > max_bytes:
+                await flush()
+            pending[custom_id] = (item, result, input_message, line)
+            pending_bytes += line_bytes
+            if len(pending) >= batch_size:
+                await flush()
+    await flush()
 
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extract rating changes from the crawled detail files.")
+    parser.add_argument('--cpu-workers', default=0, type=int,
+                        help="run HTML cleaning and JSON repair in this many worker processes (0: on the event loop)")
+    parser.add_argument('--mode', default='live', choices=['live', 'batch'],
+                        help="live: concurrent requests; batch: submit pending files through a provider batch API")
+    parser.add_argument('--batch-backend', default='openai', choices=['openai', 'local'])
+    parser.add_argument('--batch-dir', default=Path('data') / 'batches' / 'local', type=Path,
+                        help="directory of the local batch stand-in")
+    parser.add_argument('--batch-size', default=MAX_BATCH_REQUESTS, type=int, help="maximum requests per batch file")
+    parser.add_argument('--batch-max-bytes', default=MAX_BATCH_BYTES, type=int,
+                        help="maximum size of a batch input file in bytes")
+    parser.add_argument('--poll-interval', default=60.0, type=float)
+    parser.add_argument('--retry-errors', action='store_true', help="retry jobs the ledger marked as failed")
+    parser.add_argument('--consumers', default=10, type=int, help="number of concurrent extraction consumers")
+    parser.add_argument('--queue-depth', default=100, type=int, help="maximum number of files queued ahead")
+    parser.add_argument('--prefilter-threshold', default=None, type=float,
+                        help="skip the LLM for documents the local pre-filter scores below this (see prefilter.py)")
+    parser.add_argument('--rule-confidence', default=rule_confidence_threshold, type=float,
+                        help="use the rule-based extractor instead of the LLM at or above this confidence "
+                             "(above 1 disables the fast path, see python rating_rules.py for the evaluation)")
+    args = parser.parse_args()
+    batch_backend = None
+    if args.mode == 'batch':
+        if args.batch_backend == 'openai':
+            batch_backend = OpenAIBatchBackend(openai_agent)
+        else:
+            batch_backend = LocalBatchBackend(args.batch_dir)
+    run_kwargs = dict(cpu_workers=args.cpu_workers, batch_backend=batch_backend, batch_size=args.batch_size,
+                      batch_max_bytes=args.batch_max_bytes, poll_interval=args.poll_interval,
+                      retry_errors=args.retry_errors, consumers=args.consumers, queue_depth=args.queue_depth,
+                      min_prefilter_score=args.prefilter_threshold, min_rule_confidence=args.rule_confidence)
     try:
-        asyncio.run(main())
+        asyncio.run(main(**run_kwargs))
     except RuntimeError as e:
         if "This event loop is already running" in str(e):
             print("Cannot use asyncio.run(), already in event loop. Running main() directly.")
-            asyncio.ensure_future(main())  # If inside another event loop, schedule task
+            asyncio.ensure_future(main(**run_kwargs))  # If inside another event loop, schedule task
         else:
             raise e
@@ -0,0 +1,152 @@
+"""Single-pass extraction of visible text from the research html_content."""
+
+import html
+import json
+import re
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from chunking import estimate_tokens
+from publications.detail_store import DetailStore
+
+BLOCK_TAGS = (
+    'html', 'body', 'title', 'p', 'div', 'br', 'hr', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th', 'ul', 'ol',
+    'li', 'dl', 'dt', 'dd', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'section', 'article', 'header',
+    'footer',
+)
+# Everything the scanner has to stop at: comments, doctypes, whole skipped elements and block-level tags. Inline
+# tags inside a block are stripped in bulk. <head> may be left open and then ends where <body> starts; an unclosed
+# comment, <script>/<style> or a <head> followed by neither is only stripped as a marker or tag, never taken to the
+# end of the document.
+_BOUNDARY = re.compile(
+    r'<!--.*?-->|<!--|<[!?][^>]*>'
+    r'|<(script|style)\b[^>]*>.*?</\1\s*>'
+    r'|<(head)\b[^>]*>.*?(?:</head\s*>|(?=<body\b))'
+    rf'|</?(?:{"|".join(BLOCK_TAGS)})\b[^>]*>',
+    re.DOTALL | re.IGNORECASE,
+)
+_INLINE_TAG = re.compile(r'<[^>]*>')
+
+
+class ExtractedText(NamedTuple):
+    text: str
+    blocks: list
+
+
+def extract_text(html_content: str, lower=True) -> ExtractedText:
+    """Returns the visible text of `html_content` in one scan over the document.
+
+    <head>, <script> and <style> elements are dropped, entities are decoded, double quotes
+    are removed and whitespace is collapsed. `blocks` holds the text of each block-level
+    element (paragraphs, table cells, list items ...) in document order and `text` is the
+    blocks joined by a space.
+    """
+    blocks = []
+
+    def add_block(segment):
+        if '<' in segment:
+            segment = _INLINE_TAG.sub('', segment)
+        if '&' in segment:
+            segment = html.unescape(segment)
+        text = ' '.join(segment.replace('"', '').split())
+        if text:
+            blocks.append(text.lower() if lower else text)
+
+    pos = 0
+    for match in _BOUNDARY.finditer(html_content):
+        if match.start() > pos:
+            add_block(html_content[pos:match.start()])
+        pos = match.end()
+    if pos < len(html_content):
+        add_block(html_content[pos:])
+    return ExtractedText(' '.join(blocks), blocks)
+
+
+def clean_detail(raw_detail: str, token_model=None) -> dict:
+    """Parses a detail JSON document and extracts the fields process_detail_file needs.
+
+    Kept free of any I/O or global state so it can run in a worker process. With a
+    `token_model` the text's token count for that model is returned as 'tokens'.
+    """
+    data = json.loads(raw_detail)
+    if 'researchPayload' not in data:
+        return {'has_research_payload': False}
+    base_info = data['baseInfo'][0]
+    extracted = extract_text(data['researchPayload'].get('html_content', ''))
+    return {
+        'has_research_payload': True,
+        'title': base_info.get('title', None),
+        'report_publish_date': base_info.get('published_date', None),
+        'text': extracted.text,
+        'blocks': extracted.blocks,
+        'tokens': estimate_tokens(extracted.text, token_model) if token_model else None,
+    }
+
+
+def legacy_regex_clean(html_content: str) -> str:
+    """The regex chain process_detail_file used before extract_text, kept for benchmarking."""
+    html_content = html_content.lower()
+    html_content = re.sub(r'<html.*</head>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
+    html_content = re.sub(r'<script.*</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
+    html_content = re.sub(r'"', '', html_content, flags=re.DOTALL | re.IGNORECASE)
+    html_content = re.sub(r'[\n|\r|"]', '', html_content, flags=re.DOTALL | re.IGNORECASE)
+    html_content = re.sub(r'\s+', ' ', html_content, flags=re.DOTALL | re.IGNORECASE)
+    html_content = re.sub(r'<[^>]+>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
+    return html_content
+
+
+def _iter_raw_details(data_path: Path):
+    stored = set()
+    if (data_path / 'store').exists():
+        detail_store = DetailStore(data_path / 'store')
+        try:
+            for publication_id, raw in detail_store.iter_raw():
+                stored.add(publication_id)
+                yield raw
+        finally:
+            detail_store.close()
+    for detail_file in sorted(data_path.glob('*/detail/*.json')):
+        if detail_file.stem not in stored:
+            yield detail_file.read_text()
+
+
+def load_corpus(data_path: Path, limit=None) -> list:
+    """html_content of the documents in the detail store and of loose detail files not stored there."""
+    documents = []
+    for raw in _iter_raw_details(data_path):
+        data = json.loads(raw)
+        if 'researchPayload' in data:
+            documents.append(data['researchPayload'].get('html_content', ''))
+        if limit is not None and len(documents) >= limit:
+            break
+    return documents
+
+
+def benchmark(documents: list, repeat=3) -> dict:
+    total_bytes = sum(len(doc) for doc in documents)
+    timings = {}
+    for name, clean in [('regex_chain', legacy_regex_clean),
+                        ('extract_text', lambda doc: extract_text(doc).text)]:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for doc in documents:
+                clean(doc)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = {'seconds': best, 'mb_per_second': total_bytes / 1024 ** 2 / best if best else 0.0}
+    return timings
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark extract_text against the old regex cleaning chain.")
+    parser.add_argument('--data-path', default='data', type=Path)
+    parser.add_argument('--limit', default=None, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+    corpus = load_corpus(args.data_path, args.limit)
+    print(f"{len(corpus)} documents, {sum(len(doc) for doc in corpus) / 1024 ** 2:.1f} MB")
+    for name, timing in benchmark(corpus, args.repeat).items():
+        print(f"{name:>24}: {timing['seconds']:.3f}s, {timing['mb_per_second']:.1f} MB/s")
@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from loguru import logger
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+VALID = 'valid'
+INVALID = 'invalid'
+ERROR = 'error'
+STATES = (PENDING, IN_FLIGHT, VALID, INVALID, ERROR)
+
+
+class WorkLedger:
+    """SQLite job ledger with one row per publication_id.
+
+    Detail and processed directories are only listed again when their mtime changes, so a
+    resumed run starts streaming pending ids without touching every file on disk.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                publication_id TEXT PRIMARY KEY,
+                year INTEGER NOT NULL,
+                detail_path TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                cost REAL NOT NULL DEFAULT 0,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_state_year ON jobs (state, year, publication_id);
+            CREATE TABLE IF NOT EXISTS scanned_dirs (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                input_file_id TEXT,
+                input_path TEXT NOT NULL,
+                status TEXT,
+                submitted_at REAL,
+                updated_at REAL
+            );
+        """)
+        self.conn.commit()
+
+    def _dir_changed(self, directory: Path) -> bool:
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        row = self.conn.execute("SELECT mtime_ns FROM scanned_dirs WHERE path = ?", (str(directory),)).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            return False
+        self.conn.execute("INSERT OR REPLACE INTO scanned_dirs VALUES (?, ?)", (str(directory), mtime_ns))
+        return True
+
+    @staticmethod
+    def _json_names(directory: Path):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json'):
+                    yield entry.name[:-len('.json')]
+
+    def sync_year(self, year, year_path: Path):
+        """Registers new detail files of `year` and imports results produced before the ledger existed."""
+        detail_path = year_path / 'detail'
+        if self._dir_changed(detail_path):
+            now = time.time()
+            cursor = self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (publication_id, year, detail_path, updated_at) VALUES (?, ?, ?, ?)",
+                ((publication_id, year, str(detail_path / f'{publication_id}.json'), now)
+                 for publication_id in self._json_names(detail_path)))
+            logger.info(f"Ledger: {cursor.rowcount} new detail files registered for {year}")
+        for state in (VALID, INVALID):
+            processed_path = year_path / 'processed' / state
+            if self._dir_changed(processed_path):
+                self.conn.executemany(
+                    "UPDATE jobs SET state = ? WHERE publication_id = ? AND state IN ('pending', 'in_flight')",
+                    ((state, publication_id) for publication_id in self._json_names(processed_path)))
+        self.conn.commit()
+
+    def sync_store(self, detail_store, data_path: Path):
+        """Registers documents indexed in the detail store since the last sync.
+
+        The last seen index rowid is kept in scanned_dirs under the store's path, the way
+        directory mtimes are. Jobs keep the logical data/<year>/detail/<id>.json path.
+        """
+        key = f'store:{detail_store.path}'
+        row = self.conn.execute("SELECT mtime_ns FROM scanned_dirs WHERE path = ?", (key,)).fetchone()
+        rows = detail_store.ids_since(row[0] if row else 0)
+        if not rows:
+            return
+        now = time.time()
+        cursor = self.conn.executemany(
+            "INSERT OR IGNORE INTO jobs (publication_id, year, detail_path, updated_at) VALUES (?, ?, ?, ?)",
+            ((publication_id, year, str(data_path / str(year) / 'detail' / f'{publication_id}.json'), now)
+             for _, publication_id, year in rows))
+        self.conn.execute("INSERT OR REPLACE INTO scanned_dirs VALUES (?, ?)", (key, rows[-1][0]))
+        self.conn.commit()
+        logger.info(f"Ledger: {cursor.rowcount} new stored documents registered")
+
+    def register(self, publication_id, year, detail_path):
+        """Adds one job as it arrives, for documents streamed straight from the crawler."""
+        self.conn.execute(
+            "INSERT OR IGNORE INTO jobs (publication_id, year, detail_path, updated_at) VALUES (?, ?, ?, ?)",
+            (publication_id, year, str(detail_path), time.time()))
+        self.conn.commit()
+
+    def reset_in_flight(self):
+        """Jobs left in flight by an interrupted run become pending again."""
+        cursor = self.conn.execute("UPDATE jobs SET state = 'pending' WHERE state = 'in_flight'")
+        self.conn.commit()
+        if cursor.rowcount:
+            logger.info(f"Ledger: {cursor.rowcount} interrupted jobs reset to pending")
+
+    def retry_errors(self):
+        cursor = self.conn.execute("UPDATE jobs SET state = 'pending', attempts = 0 WHERE state = 'error'")
+        self.conn.commit()
+        return cursor.rowcount
+
+    def iter_pending(self, year=None, page_size=1000):
+        """Streams (publication_id, detail_path) of pending jobs, in pages so updates can interleave."""
+        last_id = ''
+        while True:
+            if year is None:
+                rows = self.conn.execute(
+                    "SELECT publication_id, detail_path FROM jobs WHERE state = 'pending' AND publication_id > ? "
+                    "ORDER BY publication_id LIMIT ?", (last_id, page_size)).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT publication_id, detail_path FROM jobs WHERE state = 'pending' AND year = ? "
+                    "AND publication_id > ? ORDER BY publication_id LIMIT ?", (year, last_id, page_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def _update(self, publication_id, state, error=None, cost=0.0, attempt=False):
+        self.conn.execute(
+            "UPDATE jobs SET state = ?, last_error = COALESCE(?, last_error), cost = cost + ?, "
+            "attempts = attempts + ?, updated_at = ? WHERE publication_id = ?",
+            (state, error, cost, 1 if attempt else 0, time.time(), publication_id))
+        self.conn.commit()
+
+    def mark_in_flight(self, publication_id):
+        self._update(publication_id, IN_FLIGHT)
+
+    def mark_done(self, publication_id, state, cost=0.0, error=None):
+        self._update(publication_id, state, error=error, cost=cost, attempt=True)
+
+    def mark_retry(self, publication_id, error, cost=0.0):
+        self._update(publication_id, IN_FLIGHT, error=error, cost=cost, attempt=True)
+
+    def mark_error(self, publication_id, error, cost=0.0):
+        self._update(publication_id, ERROR, error=error, cost=cost, attempt=True)
+
+    def mark_failed(self, publication_id, error, max_attempts, cost=0.0) -> bool:
+        """Records a failed attempt. The job goes back to pending for a later run until it has
+        failed `max_attempts` times, then becomes an error; returns whether it did."""
+        self._update(publication_id, PENDING, error=error, cost=cost, attempt=True)
+        row = self.conn.execute("SELECT attempts FROM jobs WHERE publication_id = ?", (publication_id,)).fetchone()
+        if row is None or row[0] < max_attempts:
+            return False
+        self._update(publication_id, ERROR)
+        return True
+
+    def job(self, publication_id):
+        """(detail_path, year, state) of one job, or None."""
+        return self.conn.execute("SELECT detail_path, year, state FROM jobs WHERE publication_id = ?",
+                                 (publication_id,)).fetchone()
+
+    def add_batch(self, batch_id, input_file_id, input_path):
+        """Remembers a submitted provider batch until its outputs have been collected."""
+        now = time.time()
+        self.conn.execute("INSERT OR REPLACE INTO batches VALUES (?, ?, ?, NULL, ?, ?)",
+                          (batch_id, input_file_id, str(input_path), now, now))
+        self.conn.commit()
+
+    def finish_batch(self, batch_id, status):
+        self.conn.execute("UPDATE batches SET status = ?, updated_at = ? WHERE batch_id = ?",
+                          (status, time.time(), batch_id))
+        self.conn.commit()
+
+    def open_batches(self):
+        """(batch_id, input_path) of batches submitted by an earlier run whose outputs were never collected."""
+        return self.conn.execute(
+            "SELECT batch_id, input_path FROM batches WHERE status IS NULL ORDER BY submitted_at").fetchall()
+
+    def counts(self, year=None) -> dict:
+        if year is None:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        else:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM jobs WHERE year = ? GROUP BY state",
+                                     (year,)).fetchall()
+        return dict(rows)
+
+    def close(self):
+        self.conn.close()
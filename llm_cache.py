@@ -0,0 +1,94 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from loguru import logger
+
+
+class ResponseCache:
+    """Persistent LLM response cache keyed by (model, prompt, temperature, input).
+
+    Entries are evicted least-recently-used first once the stored responses exceed
+    `max_bytes`. `hits` and `misses` count lookups for the lifetime of this object.
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created_at REAL, accessed_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, prompt, temperature, input_message) -> str:
+        payload = json.dumps([model, prompt, temperature, input_message], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, model, prompt, temperature, input_message):
+        key = self.make_key(model, prompt, temperature, input_message)
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, model, prompt, temperature, input_message, response):
+        key = self.make_key(model, prompt, temperature, input_message)
+        size = len(response.encode('utf-8'))
+        now = time.time()
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                          (key, model, response, size, now, now))
+        self.total_bytes += size - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        self.conn.commit()
+
+    def delete(self, model, prompt, temperature, input_message):
+        key = self.make_key(model, prompt, temperature, input_message)
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self.total_bytes -= row[0]
+        self.conn.commit()
+
+    def evict(self):
+        # Drop the least recently used entries until the cache is back under 90% of max_bytes
+        target = self.max_bytes * 0.9
+        evicted = 0
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} cached responses, cache size is now {self.total_bytes} bytes")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+            'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        self.conn.close()
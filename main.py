@@ -1,3 +1,18 @@
+import argparse
+
 from scrapy import cmdline
 if __name__ == '__main__':
-    cmdline.execute('scrapy crawl publication_spider'.split(' '))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Crawl Moody's rating-action publications.")
+    parser.add_argument('--incremental', action='store_true', help="only request publications after the watermarks")
+    parser.add_argument('--stream', action='store_true',
+                        help="extract rating changes while crawling instead of running data_extract.py afterwards")
+    parser.add_argument('--consumers', default=10, type=int, help="number of concurrent extraction consumers")
+    parser.add_argument('--queue-depth', default=100, type=int, help="maximum number of documents queued ahead")
+    args = parser.parse_args()
+    command = 'scrapy crawl publication_spider'.split(' ')
+    if args.incremental:
+        command += ['-a', 'incremental=1']
+    if args.stream:
+        command += ['-s', 'STREAM_EXTRACTION=1', '-s', f'STREAM_CONSUMERS={args.consumers}',
+                    '-s', f'STREAM_QUEUE_DEPTH={args.queue_depth}']
+    cmdline.execute(command)
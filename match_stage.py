@@ -0,0 +1,186 @@
+"""Matching stage: links valid extraction results to MAST_ISSR issuers and their watches.
+
+Valid results are read from the results store and matched results are appended back to it
+under the watch group they fall in (both/issr/debt/none). The Stata inputs are read once,
+normalised with vectorised date parsing and cached next to them (Parquet when
+pyarrow/fastparquet is installed, pickle otherwise). Years are matched in parallel worker
+processes, each loading the cached tables and building the company and watch indexes once.
+
+    python match_stage.py --start-year 1995 --end-year 2000 --workers 4
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+from loguru import logger
+
+from company_match import CompanyIndex
+from results_store import ResultStore, PROCESSED, MATCHED
+from watch_lookup import WatchIndex
+
+# Set by init_worker in every process that matches files
+issr_watch_index = None
+debt_watch_index = None
+company_index = None
+
+
+def normalize_watch_times(column: pd.Series, add_time="23:59:59") -> pd.Series:
+    """Parses "%Y-%m-%d %H:%M:%S" or "%Y-%m-%d" (plus `add_time`); values in neither format become NaT (open-ended)."""
+    text = column.astype(str)
+    with_time = pd.to_datetime(text, format="%Y-%m-%d %H:%M:%S", errors='coerce')
+    date_only = pd.to_datetime(text, format="%Y-%m-%d", errors='coerce') + pd.Timedelta(add_time)
+    return with_time.fillna(date_only)
+
+
+def _cache_format():
+    try:
+        import pyarrow  # noqa: F401
+        return 'parquet'
+    except ImportError:
+        pass
+    try:
+        import fastparquet  # noqa: F401
+        return 'parquet'
+    except ImportError:
+        return 'pickle'
+
+
+def load_table(dta_path: Path, cache_path: Path, prepare=None) -> pd.DataFrame:
+    """Reads a Stata table through a cache that is rebuilt when the .dta file is newer."""
+    cache_format = _cache_format()
+    cache_file = cache_path / f'{dta_path.stem}.{"parquet" if cache_format == "parquet" else "pkl"}'
+    if cache_file.exists() and cache_file.stat().st_mtime >= dta_path.stat().st_mtime:
+        return pd.read_parquet(cache_file) if cache_format == 'parquet' else pd.read_pickle(cache_file)
+    df = pd.read_stata(dta_path)
+    if prepare is not None:
+        df = prepare(df)
+    cache_path.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix('.tmp')
+    if cache_format == 'parquet':
+        df.to_parquet(tmp_file)
+    else:
+        df.to_pickle(tmp_file)
+    os.replace(tmp_file, cache_file)
+    logger.info(f"Cached {dta_path} as {cache_file}")
+    return df
+
+
+def prepare_watch_table(df: pd.DataFrame) -> pd.DataFrame:
+    df['watch_datetime'] = normalize_watch_times(df['watch_datetime'], add_time="00:00:00")
+    df['watch_end_datetime'] = normalize_watch_times(df['watch_end_datetime'], add_time="23:59:59")
+    return df
+
+
+def load_tables(data_path: Path):
+    """(issr_watch_df, debt_watch_df, mast_issr_num -> issuer_nam)."""
+    cache_path = data_path / 'cache'
+    issr_watch_df = load_table(data_path / 'ISSR_WATCH.dta', cache_path, prepare_watch_table)
+    debt_watch_df = load_table(data_path / 'DEBT_WATCH.dta', cache_path, prepare_watch_table)
+    mast_issr_df = load_table(data_path / 'MAST_ISSR.dta', cache_path)
+    return issr_watch_df, debt_watch_df, mast_issr_df.set_index('mast_issr_num')['issuer_nam'].to_dict()
+
+
+def init_worker(data_path: Path):
+    global issr_watch_index, debt_watch_index, company_index
+    issr_watch_df, debt_watch_df, mast_issr_num_name_dict = load_tables(data_path)
+    issr_watch_index = WatchIndex(issr_watch_df)
+    debt_watch_index = WatchIndex(debt_watch_df)
+    company_index = CompanyIndex.load_or_build(data_path / 'company_index.pkl', mast_issr_num_name_dict)
+
+
+def map_company(data, matches, issr_watch_rows, debt_watch_rows):
+    """Attaches the company matches and the watch rows found for the best match to `data`."""
+    data['Company Matches'] = []
+    data['Is In ISSR Watch'] = False
+    data['Is In Debt Watch'] = False
+    data['ISSR Watch'] = []
+    data['Debt Watch'] = []
+    # records.to_str stores a missing company name as ""
+    if data.get('Company Name') and data.get('report_publish_date') is not None and len(matches) > 0:
+        matches_list = pd.DataFrame(matches, columns=['Company Name', 'Score', 'Issuer Number']).to_dict(orient='records')
+        data['Company Matches'] = matches_list
+        data['Max Match Company'] = matches_list[0]
+        if len(issr_watch_rows) > 0:
+            data['ISSR Watch'] = issr_watch_index.records(issr_watch_rows)
+            data['Is In ISSR Watch'] = True
+        if len(debt_watch_rows) > 0:
+            data['Debt Watch'] = debt_watch_index.records(debt_watch_rows)
+            data['Is In Debt Watch'] = True
+    return data
+
+
+def watch_rows(watch_index: WatchIndex, keys, times, count) -> list:
+    """Rows of `watch_index` covering each (issuer, time) pair, from one vectorised join."""
+    rows = [[] for _ in range(count)]
+    for query_position, row in zip(*watch_index.join(keys, times)):
+        rows[query_position].append(row)
+    return rows
+
+
+def watch_group(data) -> str:
+    is_in_issr_watch = data.get('Is In ISSR Watch', False)
+    is_in_debt_watch = data.get('Is In Debt Watch', False)
+    if is_in_debt_watch and is_in_issr_watch:
+        return 'both'
+    elif is_in_issr_watch:
+        return 'issr'
+    elif is_in_debt_watch:
+        return 'debt'
+    return 'none'
+
+
+def match_year(year, data_path: Path, limit=2):
+    """Matches every valid result of `year` that has not been matched yet. Returns (year, matched, skipped)."""
+    results_store = ResultStore(data_path / 'results.sqlite')
+    done = results_store.publication_ids(MATCHED, year=year)
+    valid_rows = results_store.results(PROCESSED, label='valid', year=year)
+    rows = [row for row in valid_rows if row['publication_id'] not in done]
+    skipped = len(valid_rows) - len(rows)
+    # 整年的公司名称一次性批量匹配
+    matches_list = company_index.match([row['data'].get('Company Name') or '' for row in rows], limit=limit)
+    # 只为有公司名、发布日期和匹配结果的记录查询watch，整年一次向量化查询
+    queries = [position for position, (row, matches) in enumerate(zip(rows, matches_list))
+               if row['data'].get('Company Name') and row['data'].get('report_publish_date') is not None
+               and len(matches) > 0]
+    keys = [matches_list[position][0][-1] for position in queries]
+    times = pd.to_datetime(pd.Series([rows[position]['data']['report_publish_date'] for position in queries],
+                                     dtype=object), errors='coerce')
+    issr_rows = dict(zip(queries, watch_rows(issr_watch_index, keys, times, len(queries))))
+    debt_rows = dict(zip(queries, watch_rows(debt_watch_index, keys, times, len(queries))))
+    matched_rows = []
+    for position, (row, matches) in enumerate(zip(rows, matches_list)):
+        data = map_company(row['data'], matches, issr_rows.get(position, []), debt_rows.get(position, []))
+        matched_rows.append((watch_group(data), row['publication_id'], year, data))
+    results_store.append_many(MATCHED, matched_rows)
+    results_store.close()
+    logger.info(f"{year}: {len(rows)} results matched, {skipped} already matched")
+    return year, len(rows), skipped
+
+
+def main(start_year=1995, end_year=2000, data_path=Path('data'), workers=1):
+    years = list(range(start_year, end_year + 1))
+    # 先在主进程里生成缓存，避免多个进程同时转换同一个dta文件
+    init_worker(data_path)
+    if workers <= 1:
+        results = [match_year(year, data_path) for year in years]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(data_path,)) as executor:
+            results = list(executor.map(match_year, years, [data_path] * len(years)))
+    matched = sum(result[1] for result in results)
+    skipped = sum(result[2] for result in results)
+    logger.info(f"Matched {matched} results across {len(years)} years, {skipped} were already matched")
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Match valid extraction results to issuers and watch lists.")
+    parser.add_argument('--start-year', default=1995, type=int)
+    parser.add_argument('--end-year', default=2000, type=int)
+    parser.add_argument('--data-path', default='data', type=Path)
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help="years matched in parallel")
+    args = parser.parse_args()
+    main(args.start_year, args.end_year, args.data_path, args.workers)
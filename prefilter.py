@@ -0,0 +1,177 @@
+"""Cheap CPU-only scoring of whether a cleaned document reports a confirmed rating change.
+
+Documents scoring below the configured threshold are not sent to the LLM. The score comes
+from weighted phrase rules, optionally blended with a TF-IDF + logistic regression model
+trained on earlier valid and invalid results of the results store (needs scikit-learn).
+"""
+
+import math
+import pickle
+import re
+from pathlib import Path
+
+from loguru import logger
+
+from html_cleaner import clean_detail
+from publications.detail_store import DetailStore
+from results_store import ResultStore, PROCESSED
+
+_GRADES = r"(?:aaa|aa[123]|a[123]|baa[123]|ba[123]|b[123]|caa[123]|p-[123]|np)"
+# Bare "ca"/"c" are ordinary words too; they only count inside a "to X from Y" / "from X to Y" pair
+RATING = rf"(?:\(p\)\s*)?{_GRADES}"
+PAIR_RATING = rf"(?:\(p\)\s*)?(?:{_GRADES}|ca|c)"
+ACTION = r"(?:downgrade[sd]?|lower(?:s|ed)?|cut(?:s)?|upgrade[sd]?|raise[sd]?|rais(?:es|ed))"
+RULES = [
+    # Confirmed actions with a target rating: "downgraded ... senior notes to ba1"
+    (re.compile(rf"\b{ACTION}\b[^.]{{0,200}}?\bto\s+{RATING}\b"), 3.0),
+    (re.compile(rf"\bto\s+{PAIR_RATING}\s+from\s+{PAIR_RATING}\b"), 2.0),
+    (re.compile(rf"\bfrom\s+{PAIR_RATING}\s+to\s+{PAIR_RATING}\b"), 2.0),
+    # Watchlist and outlook language without an action
+    (re.compile(r"\b(?:placed|places|put|puts)\b[^.]{0,120}?\bon review\b"), -1.5),
+    (re.compile(r"\breview for possible (?:further )?(?:downgrade|upgrade)\b"), -1.5),
+    (re.compile(r"\bpossible (?:further )?(?:downgrade|upgrade)\b"), -1.0),
+    (re.compile(r"\boutlook\b[^.]{0,40}?\b(?:to|changed to|revised to)\s+(?:negative|positive|stable|developing)\b"),
+     -1.0),
+    (re.compile(r"\b(?:affirm|confirm)(?:s|ed)\b"), -0.5),
+]
+RULE_BIAS = -1.0
+LLM_NEGATIVE_REASON = "LLM model can't find downgrade information."
+# Documents of this year and later are held out of training and used to evaluate
+HOLDOUT_YEAR = 2002
+
+
+def rule_score(text: str) -> float:
+    total = RULE_BIAS
+    for pattern, weight in RULES:
+        if pattern.search(text):
+            total += weight
+    return 1.0 / (1.0 + math.exp(-total))
+
+
+class PreFilter:
+    def __init__(self, model=None, model_weight=0.5):
+        self.model = model
+        self.model_weight = model_weight
+
+    def score(self, text: str) -> float:
+        score = rule_score(text)
+        if self.model is not None:
+            model_score = float(self.model.predict_proba([text])[0][1])
+            score = self.model_weight * model_score + (1 - self.model_weight) * score
+        return score
+
+    @classmethod
+    def load(cls, path, model_weight=0.5):
+        path = Path(path)
+        if not path.exists():
+            return cls(model_weight=model_weight)
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f), model_weight=model_weight)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self.model, f)
+
+
+def iter_labelled_details(data_path: Path, years=None):
+    """Yields (result row, cleaned detail, label) for every processed result whose label came from
+    the LLM, optionally only for the results published in `years`.
+
+    Documents rejected by the keyword gate never reached the LLM and carry no label, and results
+    of the rules fast path are the rules' own answer.
+    """
+    detail_store = DetailStore(data_path / 'store')
+    results_store = ResultStore(data_path / 'results.sqlite')
+    for state, label in (('valid', 1), ('invalid', 0)):
+        for row in results_store.results(PROCESSED, label=state):
+            if years is not None and row['year'] not in years:
+                continue
+            if label == 0 and row['data'].get('InvalidReason') != LLM_NEGATIVE_REASON:
+                continue
+            if row['data'].get('Extractor') == 'rules':
+                continue
+            raw_detail = detail_store.get_raw(row['publication_id'])
+            if raw_detail is None:
+                detail_file = data_path / str(row['year']) / 'detail' / f"{row['publication_id']}.json"
+                if not detail_file.exists():
+                    continue
+                raw_detail = detail_file.read_text()
+            detail = clean_detail(raw_detail)
+            if detail['has_research_payload']:
+                yield row, detail, label
+    results_store.close()
+
+
+def load_labelled_documents(data_path: Path, years=None):
+    """Yields (text, label) of iter_labelled_details."""
+    for _, detail, label in iter_labelled_details(data_path, years):
+        yield detail['text'], label
+
+
+def split_years(holdout_year=HOLDOUT_YEAR):
+    """(training years, held-out years) for documents up to this year."""
+    return range(0, holdout_year), range(holdout_year, 10000)
+
+
+def train(data_path: Path, years=None) -> PreFilter:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+
+    texts, labels = zip(*load_labelled_documents(data_path, years))
+    model = make_pipeline(TfidfVectorizer(ngram_range=(1, 2), min_df=2, sublinear_tf=True, max_features=200000),
+                          LogisticRegression(class_weight='balanced', max_iter=1000))
+    model.fit(texts, labels)
+    logger.info(f"Trained pre-filter model on {len(texts)} documents ({sum(labels)} valid)")
+    return PreFilter(model)
+
+
+def evaluate(pre_filter: PreFilter, data_path: Path, threshold: float, years=None) -> dict:
+    """Precision/recall of "send to LLM" against the LLM's own labels, and the share of calls saved.
+
+    Pass the held-out `years` when the model was trained, otherwise the numbers are in-sample.
+    """
+    true_positive = false_positive = false_negative = skipped = total = 0
+    for text, label in load_labelled_documents(data_path, years):
+        total += 1
+        send = pre_filter.score(text) >= threshold
+        if not send:
+            skipped += 1
+        if send and label:
+            true_positive += 1
+        elif send:
+            false_positive += 1
+        elif label:
+            false_negative += 1
+    return {
+        'documents': total,
+        'precision': true_positive / (true_positive + false_positive) if true_positive + false_positive else 0.0,
+        'recall': true_positive / (true_positive + false_negative) if true_positive + false_negative else 0.0,
+        'api_calls_saved': skipped,
+        'api_calls_saved_ratio': skipped / total if total else 0.0,
+        'valid_documents_missed': false_negative,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Train or evaluate the LLM pre-filter.")
+    parser.add_argument('command', choices=['train', 'evaluate'])
+    parser.add_argument('--data-path', default='data', type=Path)
+    parser.add_argument('--model-path', default=Path('data') / 'prefilter_model.pkl', type=Path)
+    parser.add_argument('--threshold', default=0.3, type=float)
+    parser.add_argument('--holdout-year', default=HOLDOUT_YEAR, type=int,
+                        help="train on earlier years, evaluate on this year and later")
+    args = parser.parse_args()
+    train_years, holdout_years = split_years(args.holdout_year)
+    if args.command == 'train':
+        train(args.data_path, train_years).save(args.model_path)
+        logger.info(f"Saved pre-filter model to {args.model_path}")
+    else:
+        # 两者都在训练时没见过的年份上评估，结果可以直接比较
+        for name, pre_filter in [('rules', PreFilter()), ('rules+model', PreFilter.load(args.model_path))]:
+            if name == 'rules+model' and pre_filter.model is None:
+                continue
+            print(name, f"(held-out years >= {args.holdout_year})",
+                  evaluate(pre_filter, args.data_path, args.threshold, holdout_years))
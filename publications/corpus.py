@@ -0,0 +1,219 @@
+"""Read-only, memory-mapped snapshot of the crawled detail documents for analysis.
+
+`build_corpus` packs every document of the detail store (and any loose detail files) into
+an uncompressed data file plus a NumPy index sorted by publication_id. `Corpus.open` maps
+both, so a lookup is a binary search over the mapped index and fields are decoded from the
+mapped bytes only when accessed: scanning every title never touches an HTML payload.
+
+    corpus = Corpus.open('data/corpus')
+    corpus.get('PBC_123456').title
+    for document in corpus.iter(year=1999):
+        document.published_date
+"""
+
+import json
+import mmap
+import os
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from publications.detail_store import DetailStore
+
+DATA_FILE = 'corpus.bin'
+INDEX_FILE = 'corpus.idx.npy'
+# Fields of a document are stored back to back in this order, starting at `offset`
+FIELDS = ('title', 'published_date', 'meta', 'html')
+
+
+def _split_fields(details: dict):
+    base_info = (details.get('baseInfo') or [{}])[0]
+    title = base_info.get('title') or ''
+    published_date = base_info.get('published_date') or ''
+    html = ''
+    payload = details.get('researchPayload')
+    if isinstance(payload, dict) and 'html_content' in payload:
+        html = payload['html_content'] or ''
+        # html_content is kept out of the metadata and put back by Document.details
+        details = {**details, 'researchPayload': {**payload, 'html_content': None}}
+    return title, published_date, json.dumps(details, ensure_ascii=False), html
+
+
+def _iter_sources(detail_store: DetailStore, data_path: Path):
+    stored = set()
+    for publication_id, year, raw in detail_store.iter_records():
+        stored.add(publication_id)
+        yield publication_id, year, raw
+    for detail_file in sorted(data_path.glob('*/detail/*.json')):
+        if detail_file.stem not in stored and detail_file.parent.parent.name.isdigit():
+            yield detail_file.stem, int(detail_file.parent.parent.name), detail_file.read_text()
+
+
+def build_corpus(path, detail_store: DetailStore, data_path=Path('data')) -> int:
+    """Writes a fresh corpus snapshot to `path`, replacing the previous one atomically."""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rows = []
+    offset = 0
+    with open(path / f'{DATA_FILE}.tmp', 'wb') as f:
+        for publication_id, year, raw in _iter_sources(detail_store, Path(data_path)):
+            encoded = [field.encode('utf-8') for field in _split_fields(json.loads(raw))]
+            for field in encoded:
+                f.write(field)
+            rows.append((publication_id.encode('utf-8'), year, offset, *(len(field) for field in encoded)))
+            offset += sum(len(field) for field in encoded)
+    id_width = max((len(row[0]) for row in rows), default=1)
+    dtype = np.dtype([('publication_id', f'S{id_width}'), ('year', '<i2'), ('offset', '<u8')] +
+                     [(f'{field}_len', '<u4') for field in FIELDS])
+    index = np.array(rows, dtype=dtype)
+    index.sort(order='publication_id')
+    with open(path / f'{INDEX_FILE}.tmp', 'wb') as f:
+        np.save(f, index)
+    os.replace(path / f'{DATA_FILE}.tmp', path / DATA_FILE)
+    os.replace(path / f'{INDEX_FILE}.tmp', path / INDEX_FILE)
+    logger.info(f"Built corpus of {len(index)} documents ({offset / 1e6:.1f} MB) in {path}")
+    return len(index)
+
+
+class Document:
+    """One corpus entry; every field is decoded from the mapped file on first access."""
+
+    __slots__ = ('_corpus', '_row', '_cache')
+
+    def __init__(self, corpus, row):
+        self._corpus = corpus
+        self._row = row
+        self._cache = {}
+
+    @property
+    def publication_id(self) -> str:
+        return self._row['publication_id'].decode('utf-8')
+
+    @property
+    def year(self) -> int:
+        return int(self._row['year'])
+
+    def field_bytes(self, name) -> memoryview:
+        """Zero-copy view of a raw UTF-8 field; valid until the corpus is closed."""
+        start = int(self._row['offset'])
+        for field in FIELDS:
+            length = int(self._row[f'{field}_len'])
+            if field == name:
+                return self._corpus.view[start:start + length]
+            start += length
+        raise KeyError(name)
+
+    def _text(self, name) -> str:
+        if name not in self._cache:
+            view = self.field_bytes(name)
+            self._cache[name] = str(view, 'utf-8')
+            view.release()
+        return self._cache[name]
+
+    @property
+    def title(self) -> str:
+        return self._text('title')
+
+    @property
+    def published_date(self) -> str:
+        return self._text('published_date')
+
+    @property
+    def html_content(self) -> str:
+        return self._text('html')
+
+    @property
+    def details(self) -> dict:
+        """The full detail JSON as crawled."""
+        details = json.loads(self._text('meta'))
+        payload = details.get('researchPayload')
+        if isinstance(payload, dict) and payload.get('html_content', '') is None:
+            payload['html_content'] = self.html_content
+        return details
+
+    def __repr__(self):
+        return f'Document({self.publication_id!r}, year={self.year})'
+
+
+class Corpus:
+    def __init__(self, path, index, data_file, data_map):
+        self.path = path
+        self.index = index
+        self._data_file = data_file
+        self._map = data_map
+        self.view = memoryview(data_map) if data_map is not None else memoryview(b'')
+
+    @classmethod
+    def open(cls, path):
+        path = Path(path)
+        index = np.load(path / INDEX_FILE, mmap_mode='r')
+        data_file = open(path / DATA_FILE, 'rb')
+        # mmap cannot map an empty file
+        data_map = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(data_file.fileno()).st_size else None
+        return cls(path, index, data_file, data_map)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _position(self, publication_id):
+        encoded = publication_id.encode('utf-8')
+        # Casting to the fixed-width index dtype would truncate a longer id onto a different document
+        if len(encoded) > self.index.dtype['publication_id'].itemsize:
+            return None
+        key = np.array(encoded, dtype=self.index.dtype['publication_id'])
+        position = int(np.searchsorted(self.index['publication_id'], key))
+        if position < len(self.index) and self.index['publication_id'][position] == key:
+            return position
+        return None
+
+    def __contains__(self, publication_id) -> bool:
+        return self._position(publication_id) is not None
+
+    def get(self, publication_id):
+        position = self._position(publication_id)
+        return None if position is None else Document(self, self.index[position])
+
+    def iter(self, year=None):
+        """Documents of one year (or all), in file order so the mapped data is read sequentially."""
+        positions = np.arange(len(self.index)) if year is None else np.flatnonzero(self.index['year'] == year)
+        positions = positions[np.argsort(self.index['offset'][positions], kind='stable')]
+        for position in positions:
+            yield Document(self, self.index[position])
+
+    def years(self):
+        return sorted(int(year) for year in np.unique(self.index['year']))
+
+    def close(self):
+        self.view.release()
+        if self._map is not None:
+            self._map.close()
+        self._data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or query the memory-mapped detail corpus.")
+    parser.add_argument('command', choices=['build', 'get'])
+    parser.add_argument('publication_ids', nargs='*')
+    parser.add_argument('--data-path', default='data', type=Path)
+    parser.add_argument('--store-path', default=Path('data') / 'store', type=Path)
+    parser.add_argument('--corpus-path', default=Path('data') / 'corpus', type=Path)
+    args = parser.parse_args()
+    if args.command == 'build':
+        detail_store = DetailStore(args.store_path)
+        build_corpus(args.corpus_path, detail_store, args.data_path)
+        detail_store.close()
+    else:
+        with Corpus.open(args.corpus_path) as corpus:
+            for publication_id in args.publication_ids:
+                document = corpus.get(publication_id)
+                print(publication_id, None if document is None else (document.published_date, document.title))
@@ -0,0 +1,251 @@
+"""Compressed, size-rotated segment storage for crawled detail documents.
+
+Each document is appended to the current segment as its own zstd frame (gzip member when
+zstandard is not installed) holding one compact JSON line, so a segment decompresses with
+`zstd -dc`/`zcat` into plain JSONL while a single document can still be read from its
+offset. The publication_id -> (segment, offset, length) index lives in SQLite next to the
+segments and is the source of truth: bytes of a write that never reached the index are ignored.
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_SUFFIXES = {'zstd': '.jsonl.zst', 'gzip': '.jsonl.gz'}
+
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def detail_year(detail_path) -> int:
+    """Year of a data/<year>/detail/<publication_id>.json path."""
+    return int(Path(detail_path).parent.parent.name)
+
+
+class DetailStore:
+    def __init__(self, path, codec=None, max_segment_bytes=256 * 1024 * 1024, level=3):
+        self.path = Path(path)
+        self.segments_path = self.path / 'segments'
+        self.segments_path.mkdir(parents=True, exist_ok=True)
+        self.codec = codec or default_codec()
+        if self.codec == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd segments need the zstandard package")
+        self.max_segment_bytes = max_segment_bytes
+        self.level = level
+        self._lock = threading.Lock()
+        self._compressor = zstandard.ZstdCompressor(level=level) if self.codec == 'zstd' else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+        self.conn = sqlite3.connect(self.path / 'index.sqlite', check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                publication_id TEXT PRIMARY KEY,
+                year INTEGER NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS documents_year ON documents (year, publication_id);
+            CREATE INDEX IF NOT EXISTS documents_segment ON documents (segment, offset);
+        """)
+        self.conn.commit()
+        self._segment = None
+        self._segment_file = None
+
+    # 写入
+    def _compress(self, data: bytes) -> bytes:
+        if self.codec == 'zstd':
+            return self._compressor.compress(data)
+        return gzip.compress(data, compresslevel=min(self.level * 2, 9), mtime=0)
+
+    def _decompress(self, segment: str, data: bytes) -> bytes:
+        if segment.endswith(CODEC_SUFFIXES['zstd']):
+            if self._decompressor is None:
+                raise RuntimeError(f"{segment} is zstd compressed but zstandard is not installed")
+            return self._decompressor.decompress(data)
+        return gzip.decompress(data)
+
+    def _open_segment(self):
+        suffix = CODEC_SUFFIXES[self.codec]
+        if self._segment_file is not None:
+            if self._segment_file.tell() < self.max_segment_bytes:
+                return
+            self._segment_file.close()
+        numbers = [int(p.name.split('.')[0]) for p in self.segments_path.iterdir() if p.name.split('.')[0].isdigit()]
+        number = max(numbers, default=0)
+        segment = f'{number:06d}{suffix}'
+        if number == 0 or not (self.segments_path / segment).exists() \
+                or (self.segments_path / segment).stat().st_size >= self.max_segment_bytes:
+            segment = f'{number + 1:06d}{suffix}'
+        self._segment = segment
+        self._segment_file = open(self.segments_path / segment, 'ab')
+        logger.info(f"Detail store writing to segment {segment}")
+
+    def put_many(self, documents, fsync=False):
+        """Appends (publication_id, year, details) documents and indexes them in one transaction.
+
+        `details` is either the decoded dict or its JSON text. Returns the number written.
+        """
+        rows = []
+        with self._lock:
+            for publication_id, year, details in documents:
+                self._open_segment()
+                line = details if isinstance(details, str) else json.dumps(details, ensure_ascii=False)
+                frame = self._compress(line.encode('utf-8') + b'\n')
+                offset = self._segment_file.tell()
+                self._segment_file.write(frame)
+                rows.append((publication_id, int(year), self._segment, offset, len(frame)))
+            if not rows:
+                return 0
+            # 先落盘再写索引，索引里出现的文档一定可读
+            self._segment_file.flush()
+            if fsync:
+                os.fsync(self._segment_file.fileno())
+            self.conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+        return len(rows)
+
+    def put(self, publication_id, year, details):
+        self.put_many([(publication_id, year, details)])
+
+    # 读取
+    def _locate(self, publication_id):
+        with self._lock:
+            return self.conn.execute("SELECT segment, offset, length FROM documents WHERE publication_id = ?",
+                                     (publication_id,)).fetchone()
+
+    def __contains__(self, publication_id) -> bool:
+        return self._locate(publication_id) is not None
+
+    def get_raw(self, publication_id):
+        """JSON text of one document, or None if it is not stored."""
+        row = self._locate(publication_id)
+        if row is None:
+            return None
+        segment, offset, length = row
+        with open(self.segments_path / segment, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return self._decompress(segment, data).decode('utf-8')
+
+    def get(self, publication_id):
+        raw = self.get_raw(publication_id)
+        return None if raw is None else json.loads(raw)
+
+    def years(self):
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT DISTINCT year FROM documents ORDER BY year")]
+
+    def ids(self, year=None):
+        with self._lock:
+            if year is None:
+                return [row[0] for row in self.conn.execute("SELECT publication_id FROM documents")]
+            return [row[0] for row in self.conn.execute("SELECT publication_id FROM documents WHERE year = ?",
+                                                        (year,))]
+
+    def ids_since(self, rowid=0):
+        """(rowid, publication_id, year) of documents indexed after `rowid`, for incremental consumers."""
+        with self._lock:
+            return self.conn.execute("SELECT rowid, publication_id, year FROM documents WHERE rowid > ? "
+                                     "ORDER BY rowid", (rowid,)).fetchall()
+
+    def iter_records(self, year=None):
+        """Yields (publication_id, year, JSON text) in segment order, reading every segment front to back."""
+        with self._lock:
+            query = "SELECT publication_id, year, segment, offset, length FROM documents"
+            if year is None:
+                rows = self.conn.execute(f"{query} ORDER BY segment, offset").fetchall()
+            else:
+                rows = self.conn.execute(f"{query} WHERE year = ? ORDER BY segment, offset", (year,)).fetchall()
+        segment_file = None
+        current = None
+        try:
+            for publication_id, document_year, segment, offset, length in rows:
+                if segment != current:
+                    if segment_file is not None:
+                        segment_file.close()
+                    segment_file = open(self.segments_path / segment, 'rb')
+                    current = segment
+                if segment_file.tell() != offset:
+                    segment_file.seek(offset)
+                raw = self._decompress(segment, segment_file.read(length)).decode('utf-8')
+                yield publication_id, document_year, raw
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+
+    def iter_raw(self, year=None):
+        for publication_id, _, raw in self.iter_records(year):
+            yield publication_id, raw
+
+    def iter(self, year=None):
+        for publication_id, raw in self.iter_raw(year):
+            yield publication_id, json.loads(raw)
+
+    def stats(self) -> dict:
+        with self._lock:
+            documents, = self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()
+        segments = [p for p in self.segments_path.iterdir() if p.is_file()]
+        return {'documents': documents, 'segments': len(segments),
+                'bytes': sum(p.stat().st_size for p in segments)}
+
+    def close(self):
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+            self.conn.close()
+
+
+def pack_detail_files(store: DetailStore, data_path: Path, batch_size=1000, remove=False):
+    """Moves the data/<year>/detail/*.json files written by earlier crawls into the store."""
+    total = 0
+    for year_path in sorted(data_path.iterdir()):
+        detail_path = year_path / 'detail'
+        if not year_path.name.isdigit() or not detail_path.is_dir():
+            continue
+        year = int(year_path.name)
+        batch = []
+        detail_files = sorted(detail_path.glob('*.json'))
+        for detail_file in detail_files:
+            with open(detail_file, 'r') as f:
+                # 重新压缩成单行json
+                batch.append((detail_file.stem, year, json.dumps(json.load(f), ensure_ascii=False)))
+            if len(batch) >= batch_size:
+                total += store.put_many(batch)
+                batch = []
+        total += store.put_many(batch)
+        if remove:
+            for detail_file in detail_files:
+                detail_file.unlink()
+        logger.info(f"Packed {len(detail_files)} detail files of {year}")
+    return total
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack crawled detail files into the segment store.")
+    parser.add_argument('command', choices=['pack', 'stats'])
+    parser.add_argument('--data-path', default='data', type=Path)
+    parser.add_argument('--store-path', default=Path('data') / 'store', type=Path)
+    parser.add_argument('--codec', default=None, choices=list(CODEC_SUFFIXES))
+    parser.add_argument('--remove', action='store_true', help="delete the detail files once packed")
+    args = parser.parse_args()
+    detail_store = DetailStore(args.store_path, codec=args.codec)
+    if args.command == 'pack':
+        logger.info(f"Packed {pack_detail_files(detail_store, args.data_path, remove=args.remove)} documents")
+    print(detail_store.stats())
+    detail_store.close()
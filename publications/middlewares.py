@@ -4,6 +4,7 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -100,3 +101,126 @@ class PublicationsDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class EndpointThrottleMiddleware:
+    """AIMD concurrency control for each Moody's API endpoint.
+
+    Every endpoint gets its own downloader slot. A slot gains one concurrent request after
+    `ENDPOINT_THROTTLE_INCREASE_EVERY` consecutive fast successes and is cut by
+    `ENDPOINT_THROTTLE_DECREASE_FACTOR` on a 429/5xx, a download error or a response slower
+    than twice the target latency. Retry-After is honoured through the slot delay, which
+    decays again while responses succeed.
+    """
+
+    ENDPOINTS = (
+        ('widget-search', '/related-research/api/widget-search'),
+        ('research', '/research/api/research/'),
+        ('research-document', '/research-document/'),
+    )
+    THROTTLED_STATUSES = (429, 503)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start_concurrency = settings.getint('ENDPOINT_THROTTLE_START_CONCURRENCY', 4)
+        self.min_concurrency = settings.getint('ENDPOINT_THROTTLE_MIN_CONCURRENCY', 1)
+        self.max_concurrency = settings.getint('ENDPOINT_THROTTLE_MAX_CONCURRENCY', 16)
+        self.target_latency = settings.getfloat('ENDPOINT_THROTTLE_TARGET_LATENCY', 5.0)
+        self.increase_every = settings.getint('ENDPOINT_THROTTLE_INCREASE_EVERY', 10)
+        self.decrease_factor = settings.getfloat('ENDPOINT_THROTTLE_DECREASE_FACTOR', 0.5)
+        self.max_delay = settings.getfloat('ENDPOINT_THROTTLE_MAX_DELAY', 60.0)
+        self.state = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ENDPOINT_THROTTLE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def endpoint(self, url):
+        for name, marker in self.ENDPOINTS:
+            if marker in url:
+                return name
+        return None
+
+    def _state(self, name):
+        if name not in self.state:
+            self.state[name] = {'concurrency': self.start_concurrency, 'delay': 0.0, 'latency': None,
+                                'streak': 0, 'responses': 0, 'errors': 0, 'throttled': 0}
+        return self.state[name]
+
+    def process_request(self, request, spider):
+        name = self.endpoint(request.url)
+        if name is not None:
+            request.meta.setdefault('download_slot', f'moodys-{name}')
+            self._apply(name)
+        return None
+
+    def process_response(self, request, response, spider):
+        name = self.endpoint(request.url)
+        if name is None:
+            return response
+        state = self._state(name)
+        state['responses'] += 1
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            state['latency'] = latency if state['latency'] is None else 0.8 * state['latency'] + 0.2 * latency
+        if response.status in self.THROTTLED_STATUSES:
+            state['throttled'] += 1
+            self._decrease(state, self._retry_after(response))
+        elif response.status >= 500:
+            state['errors'] += 1
+            self._decrease(state)
+        elif latency is not None and latency > 2 * self.target_latency:
+            self._decrease(state)
+        elif latency is None or latency <= self.target_latency:
+            self._increase(state)
+        self._apply(name)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        name = self.endpoint(request.url)
+        if name is not None:
+            state = self._state(name)
+            state['responses'] += 1
+            state['errors'] += 1
+            self._decrease(state)
+            self._apply(name)
+        return None
+
+    def _retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        try:
+            return min(float(value), self.max_delay) if value is not None else None
+        except ValueError:
+            return None
+
+    def _increase(self, state):
+        state['streak'] += 1
+        state['delay'] = state['delay'] / 2 if state['delay'] > 0.1 else 0.0
+        if state['streak'] >= self.increase_every:
+            state['streak'] = 0
+            state['concurrency'] = min(state['concurrency'] + 1, self.max_concurrency)
+
+    def _decrease(self, state, retry_after=None):
+        state['streak'] = 0
+        state['concurrency'] = max(int(state['concurrency'] * self.decrease_factor), self.min_concurrency)
+        if retry_after is not None:
+            state['delay'] = max(state['delay'], retry_after)
+
+    def _apply(self, name):
+        state = self._state(name)
+        slot = self.crawler.engine.downloader.slots.get(f'moodys-{name}')
+        if slot is not None:
+            slot.concurrency = state['concurrency']
+            slot.delay = state['delay']
+        prefix = f'endpoint_throttle/{name}'
+        self.stats.set_value(f'{prefix}/concurrency', state['concurrency'])
+        self.stats.set_value(f'{prefix}/delay', state['delay'])
+        if state['latency'] is not None:
+            self.stats.set_value(f'{prefix}/latency_ms', round(state['latency'] * 1000))
+        if state['responses']:
+            self.stats.set_value(f'{prefix}/error_rate', round(state['errors'] / state['responses'], 4))
+            self.stats.set_value(f'{prefix}/throttled_rate', round(state['throttled'] / state['responses'], 4))
@@ -6,11 +6,174 @@
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+import asyncio
 import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+from loguru import logger
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import threads
+
+from publications.detail_store import detail_year
+
 
 class PublicationsPipeline:
+    """Owns persistence of crawled details.
+
+    Items are handed to a writer thread that saves them in batches, either into the spider's
+    detail store (one index transaction per batch) or as data/<year>/detail/<id>.json files
+    (written to a temp file and renamed). Disk I/O never runs in the reactor thread, and an
+    id is only marked as saved once its batch is on disk.
+    """
+
+    def __init__(self, stats, batch_size=200, flush_interval=5.0, fsync_interval=30.0):
+        self.stats = stats
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue()
+        self.writer = None
+        self.detail_store = None
+        self.seen_publications = None
+        self.last_fsync = time.monotonic()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(crawler.stats,
+                   batch_size=settings.getint('PUBLICATIONS_BATCH_SIZE', 200),
+                   flush_interval=settings.getfloat('PUBLICATIONS_FLUSH_INTERVAL', 5.0),
+                   fsync_interval=settings.getfloat('PUBLICATIONS_FSYNC_INTERVAL', 30.0))
+
+    def open_spider(self, spider):
+        self.detail_store = getattr(spider, 'detail_store', None)
+        self.seen_publications = getattr(spider, 'seen_publications', None)
+        self.writer = threading.Thread(target=self._run, name='publications-writer', daemon=True)
+        self.writer.start()
+
     def process_item(self, item, spider):
-        if spider.name == "publications":
-            with open(f"{item['publication_id']}.json", "a") as f:
-                json.dump(item['details'], f)
+        adapter = ItemAdapter(item)
+        if adapter.get('details') is not None:
+            self.queue.put((adapter['publication_id'], adapter['detail_path'], adapter['details']))
+        return item
+
+    def close_spider(self, spider):
+        self.queue.put(None)
+        # 等写线程把剩下的批次写完，不阻塞reactor
+        return threads.deferToThread(self.writer.join)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                entry = self.queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                entry = False
+            if entry:
+                batch.append(entry)
+            if entry is None or len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch:
+                    self._write(batch, fsync=entry is None)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+            if entry is None:
+                return
+
+    def _write(self, batch, fsync=False):
+        fsync = fsync or time.monotonic() - self.last_fsync >= self.fsync_interval
+        try:
+            if self.detail_store is not None:
+                self.detail_store.put_many(((publication_id, detail_year(detail_path), details)
+                                            for publication_id, detail_path, details in batch), fsync=fsync)
+            else:
+                for _, detail_path, details in batch:
+                    self._write_file(Path(detail_path), details, fsync)
+        except Exception as e:
+            # 没有标记为已保存，下次爬取会重新请求
+            logger.error(f"Failed to save a batch of {len(batch)} details: {e!r}")
+            self.stats.inc_value('publications/details_failed', len(batch))
+            return
+        if fsync:
+            self.last_fsync = time.monotonic()
+        if self.seen_publications is not None:
+            for publication_id, _, _ in batch:
+                self.seen_publications.mark_saved(publication_id)
+        self.stats.inc_value('publications/details_saved', len(batch))
+        self.stats.inc_value('publications/batches_written')
+
+    @staticmethod
+    def _write_file(detail_path: Path, details, fsync):
+        tmp_path = detail_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(details, f, indent=2)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, detail_path)
+
+
+class ExtractionPipeline:
+    """Streams crawled details into data_extract's consumers inside the reactor's event loop.
+
+    Enabled by STREAM_EXTRACTION. process_item waits for room in a queue of at most
+    STREAM_QUEUE_DEPTH documents, so a slow LLM stage holds items in Scrapy's scraper, which
+    stops the engine from downloading more once its active-size limit is reached.
+    """
+
+    def __init__(self, consumers=10, queue_depth=100):
+        self.consumers = consumers
+        self.queue_depth = queue_depth
+        self.extract = None
+        self.queue = None
+        self.retry_tasks = set()
+        self.consumer_tasks = []
+        self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('STREAM_EXTRACTION'):
+            raise NotConfigured
+        return cls(consumers=settings.getint('STREAM_CONSUMERS', 10),
+                   queue_depth=settings.getint('STREAM_QUEUE_DEPTH', 100))
+
+    def open_spider(self, spider):
+        # 只有流式模式才加载大模型相关的模块
+        import data_extract
+        self.extract = data_extract
+        data_extract.ledger.reset_in_flight()
+        data_extract.openai_agent.connection_limit = max(data_extract.openai_agent.connection_limit, self.consumers)
+        self.started = time.perf_counter()
+        self.queue = asyncio.Queue(maxsize=self.queue_depth)
+        self.consumer_tasks = [asyncio.ensure_future(data_extract.consumer(self.queue, self.retry_tasks))
+                               for _ in range(self.consumers)]
+
+    async def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        details = adapter.get('details')
+        detail_path = Path(adapter['detail_path'])
+        year = detail_year(detail_path)
+        if details is None or year >= self.extract.extract_before_year:
+            return item
+        publication_id = adapter['publication_id']
+        self.extract.ledger.register(publication_id, year, detail_path)
+        self.extract.streamed_details[publication_id] = json.dumps(details)
+        await self.queue.put((detail_path, year))
         return item
+
+    def close_spider(self, spider):
+        return deferred_from_coro(self._drain())
+
+    async def _drain(self):
+        logger.info(f"Crawl finished, waiting for {self.queue.qsize()} queued documents to be extracted")
+        await self.queue.join()
+        for _ in self.consumer_tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.consumer_tasks)
+        await self.extract.shutdown('stream', self.started)
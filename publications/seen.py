@@ -0,0 +1,61 @@
+import os
+from pathlib import Path
+
+from loguru import logger
+
+
+class SeenPublications:
+    """Publication ids whose detail is already on disk or already requested during this crawl.
+
+    Saved ids are kept in an append-only log (one id per line) so later crawls skip them
+    without touching the detail directories. An exact set is used rather than a bloom
+    filter: a false positive would silently drop a publication, and 30 years of ids fit
+    comfortably in memory.
+    """
+
+    def __init__(self, path, data_path=Path('data'), detail_store=None):
+        self.path = Path(path)
+        self.saved = set()
+        self.requested = set()
+        self.duplicates_avoided = 0
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                self.saved.update(line.strip() for line in f if line.strip())
+        else:
+            self._bootstrap(data_path, detail_store)
+        self._log = open(self.path, 'a')
+
+    def _bootstrap(self, data_path: Path, detail_store=None):
+        # First run with a seen log: import the detail files and stored documents saved by earlier crawls
+        if detail_store is not None:
+            self.saved.update(detail_store.ids())
+        if not data_path.exists():
+            return
+        for year_path in data_path.iterdir():
+            detail_path = year_path / 'detail'
+            if not year_path.name.isdigit() or not detail_path.is_dir():
+                continue
+            with os.scandir(detail_path) as entries:
+                self.saved.update(entry.name[:-len('.json')] for entry in entries if entry.name.endswith('.json'))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w') as f:
+            f.writelines(f'{publication_id}\n' for publication_id in sorted(self.saved))
+        logger.info(f'Imported {len(self.saved)} saved publication ids into {self.path}')
+
+    def should_request(self, publication_id) -> bool:
+        """True the first time an unsaved id is seen in this crawl; counts every other call as a duplicate."""
+        if publication_id in self.saved or publication_id in self.requested:
+            self.duplicates_avoided += 1
+            return False
+        self.requested.add(publication_id)
+        return True
+
+    def mark_saved(self, publication_id):
+        if publication_id in self.saved:
+            return
+        self.saved.add(publication_id)
+        self._log.write(f'{publication_id}\n')
+        self._log.flush()
+
+    def close(self):
+        self._log.close()
@@ -20,7 +20,8 @@ NEWSPIDER_MODULE = "publications.spiders"
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 16
+# Global ceiling; the per-endpoint limits below do the actual throttling
+CONCURRENT_REQUESTS = 48
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -50,9 +51,22 @@ SPIDER_MIDDLEWARES = {
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
+# EndpointThrottleMiddleware sits after RetryMiddleware (550) so it sees 429/5xx before they are retried
+DOWNLOADER_MIDDLEWARES = {
 #    "publications.middlewares.PublicationsDownloaderMiddleware": 543,
-#}
+   "publications.middlewares.EndpointThrottleMiddleware": 560,
+}
+
+# Per-endpoint AIMD concurrency (widget-search, research, research-document); current limits
+# are exposed as endpoint_throttle/<endpoint>/* crawler stats
+ENDPOINT_THROTTLE_ENABLED = True
+ENDPOINT_THROTTLE_START_CONCURRENCY = 4
+ENDPOINT_THROTTLE_MIN_CONCURRENCY = 1
+ENDPOINT_THROTTLE_MAX_CONCURRENCY = 16
+# Seconds; responses slower than twice this shrink the endpoint's concurrency
+ENDPOINT_THROTTLE_TARGET_LATENCY = 5.0
+ENDPOINT_THROTTLE_INCREASE_EVERY = 10
+ENDPOINT_THROTTLE_DECREASE_FACTOR = 0.5
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -64,7 +78,19 @@ EXTENSIONS = {
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
    "publications.pipelines.PublicationsPipeline": 300,
+   "publications.pipelines.ExtractionPipeline": 400,
 }
+# PublicationsPipeline writes details in batches from a background thread
+PUBLICATIONS_BATCH_SIZE = 200
+# Seconds a partial batch may wait before it is written
+PUBLICATIONS_FLUSH_INTERVAL = 5.0
+# Seconds between fsyncs of the detail store; the final batch is always fsynced
+PUBLICATIONS_FSYNC_INTERVAL = 30.0
+# ExtractionPipeline: extract rating changes from details as they are crawled (python main.py --stream)
+STREAM_EXTRACTION = False
+STREAM_CONSUMERS = 10
+# Documents waiting for the LLM stage before the crawl is held back
+STREAM_QUEUE_DEPTH = 100
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -1,13 +1,14 @@
 import scrapy
 import json
-import aiofiles
 from publications.items import PublicationsItem
+from publications.seen import SeenPublications
+from publications.detail_store import DetailStore
+from publications.watermark import PUBLISHED_KEY, WatermarkStore, published_ms
 from pathlib import Path
 from datetime import datetime
 import time
 from loguru import logger
 import copy
-import httpx
 
 
 class PublicationSpider(scrapy.Spider):
@@ -113,9 +114,31 @@ class PublicationSpider(scrapy.Spider):
                         'POSSIBLE FURTHER NEGATIVE REVIEW',
                         ]  # List of words to check for downgrade information
 
+    # 增量模式下，从水位线往前回溯的时间，避免漏掉同一时间发布的文档
+    WATERMARK_OVERLAP_MS = 24 * 3600 * 1000
+
+    def __init__(self, *args, incremental=False, storage='segments', **kwargs):
+        super().__init__(*args, **kwargs)
+        # scrapy crawl publication_spider -a storage=files: 每个详情单独写成data/<year>/detail/<id>.json
+        self.detail_store = DetailStore(Path('data') / 'store') if storage == 'segments' else None
+        # 所有检索词和年份共享，保证每个publication_id的详情在一次爬取中只请求一次
+        self.seen_publications = SeenPublications(Path('data') / 'seen_publications.txt',
+                                                  detail_store=self.detail_store)
+        # scrapy crawl publication_spider -a incremental=1: 只请求水位线之后的时间窗口，跳过已完整爬取的历史年份
+        self.incremental = str(incremental).lower() in ('1', 'true', 'yes')
+        self.watermarks = WatermarkStore(Path('data') / 'watermarks.json')
+        self.remaining_pages = {}
+        # 列表页全部处理完的查询，等爬取正常结束、详情都已保存后才推进水位线
+        self.walked_queries = {}
+        self.no_payload = set()  # 确认没有researchPayload的详情，永远不会被保存
+        self.closed_queries_skipped = 0
+        self.missing_published = 0
+
     def start_requests(self):
         # Initial POST request to start the pagination
-        year_range = range(1995, 2025)
+        # 爬到今年为止；今年的查询还会有新文档，增量模式下永远不算完整爬取
+        current_year = datetime.now().year
+        year_range = range(1995, current_year + 1)
         # researchTitle = 'downgrade'
         search_list = ['downgrade', 'upgrade', 'outlook', 'lower']
         for researchTitle in search_list:
@@ -125,6 +148,16 @@ class PublicationSpider(scrapy.Spider):
                 start_time = int(datetime(filter_year, 1, 1, 0, 0, 0).timestamp() * 1000)
                 # 2000年12月31日 23:59:59的时间戳
                 end_time = int(datetime(filter_year, 12, 31, 23, 59, 59).timestamp() * 1000)
+                watermark_key = WatermarkStore.key(researchTitle, filter_year)
+                windowed = False
+                if self.incremental:
+                    if filter_year < current_year and self.watermarks.is_closed(watermark_key, end_time):
+                        self.closed_queries_skipped += 1
+                        continue
+                    latest_published = self.watermarks.get(watermark_key).get('latest_published')
+                    if latest_published is not None and latest_published - self.WATERMARK_OVERLAP_MS > start_time:
+                        start_time = latest_published - self.WATERMARK_OVERLAP_MS
+                        windowed = True
                 json_data = copy.deepcopy(self.json_data)
                 json_data['config']['Generic_ReportsDirectoryGeneric']['publicationDateFrom'] = start_time
                 json_data['config']['Generic_ReportsDirectoryGeneric']['publicationDateTo'] = end_time
@@ -148,8 +181,12 @@ class PublicationSpider(scrapy.Spider):
                     meta={'detail_path': detail_path,
                           'json_data': json_data,
                           'researchTitle': researchTitle,
-                          'list_path': list_path}
+                          'list_path': list_path,
+                          'watermark_key': watermark_key,
+                          'windowed': windowed}
                 )
+        if self.closed_queries_skipped:
+            logger.info(f'增量模式: 跳过{self.closed_queries_skipped}个已完整爬取的历史查询')
 
     def parse(self, response):
         # Step 1: Parse the initial data response and generate data.json (simulates main.py functionality)
@@ -163,18 +200,29 @@ class PublicationSpider(scrapy.Spider):
             # Calculate the total pages based on docCount
             doc_count = data['docCount']
             total_pages = doc_count // 200 + 1
+            watermark_key = response.meta['watermark_key']
+            windowed = response.meta['windowed']
+            # 时间窗口查询只有在之前完整爬取过的基础上才能算作完整
+            covers_query = not windowed or 'completed_at' in self.watermarks.get(watermark_key)
+            self.remaining_pages[watermark_key] = {'pages': total_pages, 'doc_count': doc_count,
+                                                   'covers_query': covers_query, 'latest_published': None,
+                                                   'publication_ids': set()}
             # print(total_pages)
             # Iterate through remaining pages and request data
             for i in range(1, total_pages + 1):
                 json_data = response.meta['json_data']
                 json_data['page'] = i
-                save_path = response.meta['list_path'] / f'{response.meta["researchTitle"]}_data{i}.json'
-                if save_path.exists():
+                list_name = f'{response.meta["researchTitle"]}_incremental_data{i}.json' if windowed \
+                    else f'{response.meta["researchTitle"]}_data{i}.json'
+                save_path = response.meta['list_path'] / list_name
+                # 时间窗口每次都不同，不复用缓存的列表页
+                if save_path.exists() and not windowed:
                     try:
                         with open(save_path, 'r') as data_file:
                             data = json.load(data_file)
                             # logger.info(f'读取{save_path}成功')
-                            yield from self.parse_page_data(data, response.meta['detail_path'])
+                            yield from self.parse_page_data(data, response.meta['detail_path'], watermark_key)
+                        self.page_done(watermark_key)
                         continue
                     except Exception as e:
                         logger.error(f'读取{save_path}失败, {e}')
@@ -188,7 +236,8 @@ class PublicationSpider(scrapy.Spider):
                     meta={'page': i, "list_path": response.meta['list_path'],
                           'researchTitle': response.meta['researchTitle'],
                           'save_path': save_path,
-                          'detail_path': response.meta['detail_path']},
+                          'detail_path': response.meta['detail_path'],
+                          'watermark_key': watermark_key},
                     dont_filter=True
                 )
 
@@ -205,16 +254,50 @@ class PublicationSpider(scrapy.Spider):
                 json.dump(data, data_file, indent=2)
             # async with aiofiles.open(save_path, 'w') as data_file:
             #     await data_file.write(json.dumps(data, indent=2))
-            yield from self.parse_page_data(data, response.meta['detail_path'])
+            yield from self.parse_page_data(data, response.meta['detail_path'], response.meta['watermark_key'])
+            self.page_done(response.meta['watermark_key'])
+
+    def page_done(self, watermark_key):
+        # 一个查询的所有列表页都处理完后，交给closed()在详情保存后推进水位线
+        remaining = self.remaining_pages.get(watermark_key)
+        if remaining is None:
+            return
+        remaining['pages'] -= 1
+        if remaining['pages'] == 0:
+            del self.remaining_pages[watermark_key]
+            self.walked_queries[watermark_key] = remaining
+
+    def advance_watermarks(self):
+        """Advances the watermark of every fully walked query whose requested details were all saved.
+
+        Returns the number of walked queries left behind because some detail was never saved.
+        """
+        unsaved_queries = 0
+        for watermark_key, walk in self.walked_queries.items():
+            unsaved = walk['publication_ids'] - self.seen_publications.saved - self.no_payload
+            if unsaved:
+                unsaved_queries += 1
+                logger.warning(f'{watermark_key}有{len(unsaved)}个详情没有保存, 不推进水位线')
+                continue
+            self.watermarks.advance(watermark_key, walk['latest_published'])
+            if walk['covers_query']:
+                self.watermarks.mark_complete(watermark_key, walk['doc_count'])
+        return unsaved_queries
 
-    def parse_page_data(self, data, detail_path):
+    def parse_page_data(self, data, detail_path, watermark_key=None):
         # Extract publication_id and proceed to get details
+        walk = self.remaining_pages.get(watermark_key)
         for result in data['results']:
             publication_id = result['publication_id']
+            if walk is not None:
+                published = published_ms(result)
+                if published is None:
+                    # 没有发布时间的记录不推进水位线
+                    self.missing_published += 1
+                    logger.warning(f'{publication_id}没有{PUBLISHED_KEY}, 不计入水位线')
+                elif walk['latest_published'] is None or published > walk['latest_published']:
+                    walk['latest_published'] = published
             detail_file_save_path = detail_path / f'{publication_id}.json'
-            if detail_file_save_path.exists():
-                # logger.info(f'{publication_id}已经存在，跳过')
-                continue
             title = result.get('title', None)
             if title is None:
                 # logger.info(f'{publication_id}没有标题，跳过')
@@ -231,6 +314,11 @@ class PublicationSpider(scrapy.Spider):
                     continue
             # if publication_id != '':
             #     continue
+            if walk is not None:
+                walk['publication_ids'].add(publication_id)
+            if not self.seen_publications.should_request(publication_id):
+                # logger.info(f'{publication_id}已经存在或已请求，跳过')
+                continue
             yield scrapy.Request(
                 url=f'https://www.moodys.com/research/api/research/{publication_id}',
                 callback=self.parse_details,
@@ -250,26 +338,68 @@ class PublicationSpider(scrapy.Spider):
             if asp_path is not None:
                 asp_path = asp_path.get('asp', None)
                 if asp_path is not None:
-                    async with httpx.AsyncClient() as client:
-                        r = await client.get(f'https://www.moodys.com/research-document/{asp_path}', timeout=100)
-                        if r.status_code == 200:
-                            details['researchPayload'] = {
-                                'entity_type': 'research_payload',
-                                'html_content': r.text,
-                                'publication_id': publication_id,
-                                'parse_by_another_request': True,
-                            }
-                        else:
-                            logger.warning(f'{publication_id}获取html失败')
+                    # 通过scrapy的下载器获取html，与其他请求共享连接池、限速和重试
+                    yield scrapy.Request(
+                        url=f'https://www.moodys.com/research-document/{asp_path}',
+                        callback=self.parse_research_document,
+                        errback=self.research_document_failed,
+                        cookies=self.cookies,
+                        headers=self.headers,
+                        meta={'publication_id': publication_id,
+                              'detail_file_save_path': response.meta['detail_file_save_path'],
+                              'details': details,
+                              'download_timeout': 100}
+                    )
+                    return
+        item = self.save_details(publication_id, details, response.meta['detail_file_save_path'])
+        if item is not None:
+            yield item
+
+    async def parse_research_document(self, response):
+        publication_id = response.meta['publication_id']
+        details = response.meta['details']
+        details['researchPayload'] = {
+            'entity_type': 'research_payload',
+            'html_content': response.text,
+            'publication_id': publication_id,
+            'parse_by_another_request': True,
+        }
+        item = self.save_details(publication_id, details, response.meta['detail_file_save_path'])
+        if item is not None:
+            yield item
+
+    def research_document_failed(self, failure):
+        publication_id = failure.request.meta['publication_id']
+        logger.warning(f'{publication_id}获取html失败, {failure.value!r}')
+        logger.warning(f'{publication_id}没有找到researchPayload')
+
+    def save_details(self, publication_id, details, detail_file_save_path):
         if 'researchPayload' not in details:
             logger.warning(f'{publication_id}没有找到researchPayload')
-            return
-        # Save details in detail.json asynchronously
-        async with aiofiles.open(response.meta['detail_file_save_path'], 'w') as detail_file:
-            await detail_file.write(json.dumps(details, indent=2))
-        # Yield the details to Scrapy's pipeline or directly write them to the output file
+            self.no_payload.add(publication_id)
+            return None
+        # 由PublicationsPipeline在后台线程批量写入，写入成功后才标记为已保存
         item = PublicationsItem()
         item['publication_id'] = publication_id
-        item['detail_path'] = str(response.meta['detail_file_save_path'])
-        # item['details'] = details
-        yield item
+        item['detail_path'] = str(detail_file_save_path)
+        item['details'] = details
+        return item
+
+    def closed(self, reason):
+        duplicates_avoided = self.seen_publications.duplicates_avoided
+        self.crawler.stats.set_value('publications/duplicates_avoided', duplicates_avoided)
+        self.crawler.stats.set_value('publications/details_requested', len(self.seen_publications.requested))
+        self.crawler.stats.set_value('publications/missing_published_date', self.missing_published)
+        logger.info(f'{duplicates_avoided}个重复的详情请求被跳过, '
+                    f'本次请求了{len(self.seen_publications.requested)}个新的详情')
+        # closed()在pipeline写完所有批次之后调用；中断或失败的爬取不推进水位线
+        if reason == 'finished':
+            unsaved_queries = self.advance_watermarks()
+            self.crawler.stats.set_value('publications/watermarks_held_back', unsaved_queries)
+            self.watermarks.save()
+        else:
+            logger.warning(f'爬取没有正常结束({reason}), 不更新水位线')
+        self.seen_publications.close()
+        if self.detail_store is not None:
+            self.crawler.stats.set_value('publications/detail_store', self.detail_store.stats())
+            self.detail_store.close()
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+# widget-search results carry their publication time in the same field as the detail baseInfo
+PUBLISHED_KEY = 'published_date'
+
+
+def published_ms(result):
+    """Publication time of a widget-search result in epoch milliseconds, or None if it has none."""
+    value = result.get(PUBLISHED_KEY)
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value if value > 1e11 else value * 1000)
+    try:
+        return int(datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+class WatermarkStore:
+    """Per-query crawl watermarks keyed by (search term, year).
+
+    A watermark records the latest publication time and docCount of the query and when a
+    full walk of it completed. The spider only advances it at the end of a finished crawl,
+    for queries whose listing walk finished and whose requested details were all saved.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.marks = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                self.marks = json.load(f)
+
+    @staticmethod
+    def key(research_title, year):
+        return f'{research_title}:{year}'
+
+    def get(self, key) -> dict:
+        return self.marks.get(key, {})
+
+    def is_closed(self, key, year_end_ms) -> bool:
+        """A query is closed once a full walk finished after the end of its date range."""
+        completed_at = self.get(key).get('completed_at')
+        return completed_at is not None and completed_at > year_end_ms
+
+    def advance(self, key, published):
+        if published is None:
+            return
+        mark = self.marks.setdefault(key, {})
+        if published > mark.get('latest_published', 0):
+            mark['latest_published'] = published
+
+    def mark_complete(self, key, doc_count):
+        mark = self.marks.setdefault(key, {})
+        mark['doc_count'] = doc_count
+        mark['completed_at'] = int(time.time() * 1000)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.marks, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
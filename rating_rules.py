@@ -0,0 +1,247 @@
+"""Rule-based extraction of Moody's rating changes from cleaned, lower-case release text.
+
+Rating-action releases are formulaic ("downgraded the senior unsecured rating of X to Ba1
+from Baa3"), so most of them can be turned into the `Product Ratings` schema of the
+extraction prompt without a model call. `extract_rating_changes` returns that dict together
+with a confidence in [0, 1]; callers fall back to the LLM when the confidence is low.
+`python rating_rules.py` scores the rules against the LLM labels in the results store.
+"""
+
+import re
+from pathlib import Path
+
+LONG_TERM_SCALE = ['Aaa', 'Aa1', 'Aa2', 'Aa3', 'A1', 'A2', 'A3', 'Baa1', 'Baa2', 'Baa3', 'Ba1', 'Ba2', 'Ba3',
+                   'B1', 'B2', 'B3', 'Caa1', 'Caa2', 'Caa3', 'Ca', 'C']
+SHORT_TERM_SCALE = ['P-1', 'P-2', 'P-3', 'NP']
+_CANONICAL = {rating.lower(): rating for rating in LONG_TERM_SCALE + SHORT_TERM_SCALE}
+_CANONICAL.update({'prime-1': 'P-1', 'prime-2': 'P-2', 'prime-3': 'P-3', 'not prime': 'NP', 'not-prime': 'NP'})
+_RANK = {rating: rank for scale in (LONG_TERM_SCALE, SHORT_TERM_SCALE) for rank, rating in enumerate(scale)}
+# Ba1 and below is speculative grade; NP is the short-term counterpart
+SPECULATIVE_GRADE = set(LONG_TERM_SCALE[LONG_TERM_SCALE.index('Ba1'):]) | {'NP'}
+
+RATING = (r"(?:\(p\)\s*)?(?:aaa|aa[123]|a[123]|baa[123]|ba[123]|b[123]|caa[123]|ca|c|p-[123]|prime-[123]"
+          r"|not[ -]prime|np)(?![\w-])")
+DOWN_VERBS = r"downgrade[sd]?|lower(?:s|ed)?|cut(?:s)?|reduce[sd]?"
+UP_VERBS = r"upgrade[sd]?|raise[sd]?|rais(?:es|ed)|increase[sd]?"
+ACTION = rf"(?:{DOWN_VERBS}|{UP_VERBS})"
+_DOWN = re.compile(rf"^(?:{DOWN_VERBS})$")
+_VERB = re.compile(rf"\b(?:{ACTION})\b")
+_PAIR = re.compile(rf"\bto\s+(?P<new>{RATING})(?:\s*\(?\s*from\s+(?P<old>{RATING}))?")
+_TRAILING_FROM = re.compile(rf"\bfrom\s+(?P<old>{RATING})\s*,?\s*$")
+_PRODUCT = re.compile(r"^(?P<before>.*?)\bratings?\b(?:\s+(?:of|on|for|assigned to)\s+(?P<after>.*))?$")
+_LEADING_NOISE = re.compile(r"^(?:(?:the|its|their|all|of|on|for|and|also)(?:\s+|$))+")
+_TRAILING_NOISE = re.compile(r"\s+(?:was|were|is|are|has been|have been|had been|each)$")
+VERB_WINDOW = 300
+# Words that cannot be a product or start a company name; the regexes above capture them from
+# sentences like "lowered the rating of ..." or "changes outlook of ..."
+_STOP_PRODUCTS = {'', 'the', 'its', 'their', 'all', 'of', 'on', 'for', 'and', 'also', 'it', 'them', 'this', 'these',
+                  'rating', 'ratings'}
+_UP_TITLE_VERB = re.compile(r"^(?:upgrades|raises)$")
+_NOT_COMPANY = {'outlook', 'outlooks', 'rating', 'ratings', 'review', 'reviews', 'watch', 'its', 'their', 'all'}
+_HEDGES = re.compile(r"\b(?:possible (?:further )?(?:downgrade|upgrade)|review for|placed on review|"
+                     r"under review|direction uncertain|may (?:downgrade|lower|upgrade|raise))\b")
+_TITLE_COMPANY = re.compile(
+    r"moody'?s\s+(?:investors service\s+)?(?P<verb>downgrades|lowers|cuts|upgrades|raises|confirms|affirms|changes)\s+"
+    r"(?:the\s+)?(?:(?:debt\s+)?ratings?\s+(?:of|on|for)\s+)?"
+    r"(?P<company>.+?)(?:'s?(?=\s|$)|\s+(?:senior|sub|subordinated|long-term|short-term|debt|notes|bonds|ratings?|"
+    r"to|from|and|;|,|\()|$)",
+    re.IGNORECASE,
+)
+
+
+def normalize_rating(token):
+    """Maps a rating token in any case/spelling to Moody's canonical form, or None if it is not one."""
+    if token is None:
+        return None
+    token = ' '.join(str(token).strip().split())
+    provisional = token.lower().startswith('(p)')
+    if provisional:
+        token = token[3:].strip()
+    rating = _CANONICAL.get(token.lower())
+    if rating is None:
+        return None
+    return f"(P){rating}" if provisional else rating
+
+
+def rating_rank(rating):
+    """Position of a rating on its scale (0 is best), or None for unknown ratings."""
+    rating = normalize_rating(rating)
+    if rating is None:
+        return None
+    return _RANK[rating[3:] if rating.startswith('(P)') else rating]
+
+
+def is_speculative_grade(rating) -> bool:
+    rating = normalize_rating(rating)
+    return rating is not None and rating.replace('(P)', '') in SPECULATIVE_GRADE
+
+
+def _is_short_term(rating) -> bool:
+    return rating.replace('(P)', '') in SHORT_TERM_SCALE
+
+
+def _product_name(segment: str) -> str:
+    segment = ' '.join(segment.strip(' ,.:;').split())
+    segment = _TRAILING_FROM.sub('', segment).strip(' ,')
+    match = _PRODUCT.match(segment)
+    if match:
+        product = match.group('before').strip(' ,') or (match.group('after') or '').strip(' ,')
+    else:
+        product = segment
+    product = _LEADING_NOISE.sub('', product)
+    return _TRAILING_NOISE.sub('', product).strip(' ,')
+
+
+def _title_match(title):
+    if not title:
+        return None
+    match = _TITLE_COMPANY.search(title)
+    if match is None:
+        return None
+    company = match.group('company').strip(' ,.-')
+    if not company or company.split()[0].lower() in _NOT_COMPANY:
+        return None
+    return match
+
+
+def company_from_title(title):
+    match = _title_match(title)
+    return None if match is None else match.group('company').strip(' ,.-')
+
+
+def extract_rating_changes(text: str, title=None, publication_date=None):
+    """Returns (result, confidence) for the downgrades found in `text`.
+
+    `result` follows the schema of the extraction prompt in data_extract.py. Only
+    downgrades count as new ratings, matching the prompt; upgrades and hedged or
+    inconsistent matches lower the confidence so the caller asks the LLM instead.
+    """
+    changes = []
+    seen = set()
+    inconsistent = False
+    unconsumed = 0  # rating pairs no rule turned into a downgrade
+    previous_end = 0
+    for match in _PAIR.finditer(text):
+        # The governing verb is the last action verb shortly before the rating pair; several pairs
+        # can share it ("downgraded X to ba1 from baa3 and its cp rating to np from p-3")
+        window_start = max(0, match.start() - VERB_WINDOW)
+        verbs = list(_VERB.finditer(text, window_start, match.start()))
+        if not verbs:
+            previous_end = match.end()
+            unconsumed += 1
+            continue
+        verb = verbs[-1]
+        new = normalize_rating(match.group('new'))
+        content_start = verb.start() if verb.end() > previous_end else previous_end
+        segment = text[max(verb.end(), previous_end):match.start()]
+        previous_end = match.end()
+        old = match.group('old')
+        if old is None:
+            trailing = _TRAILING_FROM.search(segment)
+            old = trailing.group('old') if trailing else None
+        old = normalize_rating(old)
+        is_downgrade = bool(_DOWN.match(verb.group(0)))
+        if old is not None and _is_short_term(old) == _is_short_term(new):
+            moved_down = rating_rank(new) > rating_rank(old)
+            if moved_down != is_downgrade:
+                inconsistent = True
+                unconsumed += 1
+                continue
+        if not is_downgrade:
+            unconsumed += 1
+            continue
+        product = _product_name(segment)
+        key = (product, old, new)
+        if key in seen:
+            continue
+        seen.add(key)
+        changes.append({
+            "Product Name": product,
+            "Rating Change": {
+                "Old Rating": old,
+                "New Rating": new,
+                "Change Reason": "",
+                "Raw Content": ' '.join(text[content_start:match.end()].split()).strip(' ,;:'),
+                "Is Subsidiary Product": False,
+                "Subsidiary Name": "",
+            },
+        })
+
+    title_match = _title_match(title)
+    company = title_match.group('company').strip(' ,.-') if title_match else None
+    result = {
+        "Company Name": company or "",
+        "Has New Rating": bool(changes),
+        "Reason": "" if changes else "No confirmed downgrade with a new rating found by the rule extractor",
+        "Publication Date": publication_date or "",
+        "Product Ratings": changes,
+    }
+    if not changes:
+        return result, 0.0
+    confidence = 0.3
+    # 标题里的公司必须在正文中出现，且标题动作与正文方向一致，否则很可能是另一家公司的评级
+    if company and company.lower() in text and not _UP_TITLE_VERB.match(title_match.group('verb').lower()):
+        confidence += 0.3
+    elif company:
+        confidence -= 0.3
+    if any(change["Product Name"].lower() in _STOP_PRODUCTS for change in changes):
+        confidence -= 0.5
+    if unconsumed:
+        confidence -= 0.2
+    if all(change["Rating Change"]["Old Rating"] is not None for change in changes):
+        confidence += 0.2
+    if not inconsistent:
+        confidence += 0.1
+    if _HEDGES.search(text):
+        confidence -= 0.3
+    else:
+        confidence += 0.1
+    return result, max(0.0, min(confidence, 1.0))
+
+
+def new_ratings(data: dict) -> set:
+    """New ratings of every product in an extraction result, across all its companies."""
+    ratings = set()
+    for company in data.get('Companies') or [data]:
+        for product in company.get('Product Ratings') or []:
+            if isinstance(product, dict) and isinstance(product.get('Rating Change'), dict):
+                ratings.add(normalize_rating(product['Rating Change'].get('New Rating')))
+    return ratings - {None}
+
+
+def evaluate(data_path: Path, thresholds, years=None) -> dict:
+    """How the rules fast path would have done against the LLM's stored labels at each threshold.
+
+    A document is taken by the rules when its confidence reaches the threshold. `precision` is
+    the share of those the LLM also labelled as a downgrade and `new_ratings_agree` the share of
+    those where both found the same set of new ratings.
+    """
+    # prefilter imports results_store, which imports this module
+    from prefilter import iter_labelled_details
+
+    scored = []
+    for row, detail, label in iter_labelled_details(Path(data_path), years):
+        result, confidence = extract_rating_changes(detail['text'], detail['title'], detail['report_publish_date'])
+        scored.append((confidence, label, label == 1 and new_ratings(result) == new_ratings(row['data'])))
+    report = {}
+    for threshold in thresholds:
+        taken = [(label, agree) for confidence, label, agree in scored if confidence > 0 and confidence >= threshold]
+        report[threshold] = {
+            'documents': len(scored),
+            'taken_by_rules': len(taken),
+            'api_calls_saved_ratio': len(taken) / len(scored) if scored else 0.0,
+            'precision': sum(label for label, _ in taken) / len(taken) if taken else 0.0,
+            'new_ratings_agree': sum(agree for _, agree in taken) / len(taken) if taken else 0.0,
+        }
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Evaluate the rule extractor against the stored LLM labels.")
+    parser.add_argument('--data-path', default='data', type=Path)
+    parser.add_argument('--thresholds', default=[0.6, 0.7, 0.8, 0.9, 1.0], type=float, nargs='+')
+    args = parser.parse_args()
+    for threshold, metrics in evaluate(args.data_path, args.thresholds).items():
+        print(f"confidence >= {threshold}:", metrics)
@@ -0,0 +1,166 @@
+"""Typed extraction results.
+
+Model and rule outputs follow the JSON schema of the extraction prompt in data_extract.py.
+`parse_extraction` validates that dict into slotted Company / ProductRating / RatingChange
+records: booleans arrive as true/"True"/"true", missing strings become "", and rating tokens
+are normalised to Moody's canonical spelling through rating_rules. `to_dict` writes the
+records back in the prompt schema, so processed files keep their keys.
+"""
+
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from rating_rules import normalize_rating
+
+UNKNOWN_RATINGS = {'', 'unknown', 'null', 'none', 'n/a', 'na', 'nr', 'not rated', 'withdrawn'}
+
+
+class RecordError(ValueError):
+    pass
+
+
+def to_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() == 'true'
+    return value is True or value == 1
+
+
+def to_str(value) -> str:
+    return '' if value is None else str(value).strip()
+
+
+def to_rating(value) -> Optional[str]:
+    """Canonical rating, None when missing or unknown, or the stripped token when it is not a Moody's rating."""
+    token = to_str(value)
+    if token.lower() in UNKNOWN_RATINGS:
+        return None
+    return normalize_rating(token) or token
+
+
+@dataclass(slots=True)
+class RatingChange:
+    old_rating: Optional[str] = None
+    new_rating: Optional[str] = None
+    change_reason: str = ''
+    raw_content: str = ''
+    is_subsidiary_product: bool = False
+    subsidiary_name: str = ''
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        if not isinstance(data, dict):
+            raise RecordError(f"Rating Change must be an object, got {type(data).__name__}")
+        return cls(old_rating=to_rating(data.get('Old Rating')),
+                   new_rating=to_rating(data.get('New Rating')),
+                   change_reason=to_str(data.get('Change Reason')),
+                   raw_content=to_str(data.get('Raw Content')),
+                   is_subsidiary_product=to_bool(data.get('Is Subsidiary Product')),
+                   subsidiary_name=to_str(data.get('Subsidiary Name')))
+
+    def to_dict(self) -> dict:
+        return {
+            "Old Rating": self.old_rating,
+            "New Rating": self.new_rating,
+            "Change Reason": self.change_reason,
+            "Raw Content": self.raw_content,
+            "Is Subsidiary Product": self.is_subsidiary_product,
+            "Subsidiary Name": self.subsidiary_name,
+        }
+
+
+@dataclass(slots=True)
+class ProductRating:
+    product_name: str
+    rating_change: RatingChange
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        if not isinstance(data, dict):
+            raise RecordError(f"Product Ratings entries must be objects, got {type(data).__name__}")
+        return cls(product_name=to_str(data.get('Product Name')),
+                   rating_change=RatingChange.from_dict(data.get('Rating Change') or {}))
+
+    def to_dict(self) -> dict:
+        return {"Product Name": self.product_name, "Rating Change": self.rating_change.to_dict()}
+
+
+@dataclass(slots=True)
+class Company:
+    company_name: str
+    has_new_rating: bool = False
+    reason: str = ''
+    publication_date: str = ''
+    product_ratings: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        if not isinstance(data, dict):
+            raise RecordError(f"a company must be an object, got {type(data).__name__}")
+        products = data.get('Product Ratings') or []
+        if not isinstance(products, list):
+            raise RecordError("Product Ratings must be a list")
+        return cls(company_name=to_str(data.get('Company Name')),
+                   has_new_rating=to_bool(data.get('Has New Rating')),
+                   reason=to_str(data.get('Reason')),
+                   publication_date=to_str(data.get('Publication Date')),
+                   # 与merge_extractions一致，忽略不是对象的条目
+                   product_ratings=[ProductRating.from_dict(product) for product in products
+                                    if isinstance(product, dict)])
+
+    def to_dict(self) -> dict:
+        return {
+            "Company Name": self.company_name,
+            "Has New Rating": self.has_new_rating,
+            "Reason": self.reason,
+            "Publication Date": self.publication_date,
+            "Product Ratings": [product.to_dict() for product in self.product_ratings],
+        }
+
+
+SCHEMA_KEYS = {'Company Name', 'Has New Rating', 'Reason', 'Publication Date', 'Product Ratings', 'Companies'}
+
+
+def parse_extraction(json_result: dict) -> list:
+    """Companies reported by one extraction; chunked extractions list several under "Companies"."""
+    if not json_result:
+        return []
+    if not isinstance(json_result, dict):
+        raise RecordError(f"extraction result must be an object, got {type(json_result).__name__}")
+    companies = json_result.get('Companies')
+    if companies:
+        return [Company.from_dict(company) for company in companies]
+    return [Company.from_dict(json_result)]
+
+
+def result_fields(companies: list, json_result: dict) -> dict:
+    """Fields written into a processed result: the first company flattened, all of them under
+    "Companies" when there are several, plus any non-schema metadata (e.g. the extractor)."""
+    fields = {key: value for key, value in (json_result or {}).items() if key not in SCHEMA_KEYS}
+    if companies:
+        fields.update(companies[0].to_dict())
+        if len(companies) > 1:
+            fields['Companies'] = [company.to_dict() for company in companies]
+            fields['Has New Rating'] = any(company.has_new_rating for company in companies)
+    return fields
+
+
+def detail_reference(detail_file: Path) -> dict:
+    """Pointer to the crawled document a result came from, stored instead of its text."""
+    detail_file = Path(detail_file)
+    return {'publication_id': detail_file.stem, 'year': int(detail_file.parent.parent.name),
+            'detail_path': str(detail_file)}
+
+
+def load_html_content(detail_ref: dict, corpus=None, detail_store=None) -> str:
+    """Resolves a detail reference through the corpus snapshot, the detail store or the loose file."""
+    publication_id = detail_ref['publication_id']
+    if corpus is not None:
+        document = corpus.get(publication_id)
+        if document is not None:
+            return document.html_content
+    raw_detail = detail_store.get_raw(publication_id) if detail_store is not None else None
+    if raw_detail is None:
+        raw_detail = Path(detail_ref['detail_path']).read_text()
+    return json.loads(raw_detail).get('researchPayload', {}).get('html_content', '')
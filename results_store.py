@@ -0,0 +1,268 @@
+"""Append-only SQLite store for extraction and matching results.
+
+Every processed or matched result is one row of `results`: the full JSON document plus
+indexed columns (year, publication_id, company, watch flags). Each product rating change
+is also written to `rating_changes` with its old/new rating, ranks and speculative-grade
+flags, so questions like "all downgrades to speculative grade in 1999" are an indexed
+query instead of a glob over thousands of JSON files:
+
+    store = ResultStore('data/results.sqlite')
+    store.downgrades(year=1999, to_speculative=True)
+    store.results(MATCHED, year=1999, issr_watch=True)
+
+Rows are never updated in place except for the `current` flag: writing a publication again
+for the same stage appends new rows and retires the old ones. Results written as JSON files
+by earlier runs are imported with `python results_store.py import`.
+"""
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from rating_rules import SHORT_TERM_SCALE, is_speculative_grade, normalize_rating, rating_rank
+
+PROCESSED = 'processed'
+MATCHED = 'matched'
+# processed results are valid/invalid, matched ones are grouped by the watch lists they are in
+LABELS = {PROCESSED: ('valid', 'invalid'), MATCHED: ('both', 'issr', 'debt', 'none')}
+
+
+def _flag(value):
+    return None if value is None else int(bool(value))
+
+
+def issuer_key(value):
+    """mast_issr_num as stored: integral numbers (12345, 12345.0, "12345") all become "12345"."""
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value).strip() or None
+    if number != number:  # NaN
+        return None
+    return str(int(number)) if number.is_integer() else str(value)
+
+
+def _same_scale(old_rating, new_rating) -> bool:
+    return (old_rating.replace('(P)', '') in SHORT_TERM_SCALE) == (new_rating.replace('(P)', '') in SHORT_TERM_SCALE)
+
+
+def rating_change_rows(data: dict):
+    """(company, product, old, new, old_rank, new_rank, downgrade, upgrade, old_speculative, new_speculative)
+    for every product rating change of a result, across all companies of a chunked extraction."""
+    for company in data.get('Companies') or [data]:
+        if not isinstance(company, dict):
+            continue
+        for product in company.get('Product Ratings') or []:
+            if not isinstance(product, dict):
+                continue
+            change = product.get('Rating Change') or {}
+            old_rating = normalize_rating(change.get('Old Rating'))
+            new_rating = normalize_rating(change.get('New Rating'))
+            old_rank, new_rank = rating_rank(old_rating), rating_rank(new_rating)
+            comparable = old_rating is not None and new_rating is not None and _same_scale(old_rating, new_rating)
+            yield (company.get('Company Name'), product.get('Product Name'),
+                   old_rating or change.get('Old Rating'), new_rating or change.get('New Rating'), old_rank, new_rank,
+                   int(comparable and new_rank > old_rank), int(comparable and new_rank < old_rank),
+                   _flag(is_speculative_grade(old_rating)) if old_rating else None,
+                   _flag(is_speculative_grade(new_rating)) if new_rating else None)
+
+
+class ResultStore:
+    def __init__(self, path, timeout=60.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 匹配阶段的多个进程会同时写入，等待锁而不是直接报错
+        self.conn = sqlite3.connect(self.path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY,
+                stage TEXT NOT NULL,
+                label TEXT NOT NULL,
+                publication_id TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                current INTEGER NOT NULL DEFAULT 1,
+                company TEXT COLLATE NOCASE,
+                has_new_rating INTEGER,
+                report_publish_date TEXT,
+                mast_issr_num TEXT,
+                is_in_issr_watch INTEGER,
+                is_in_debt_watch INTEGER,
+                data TEXT NOT NULL,
+                created_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS results_publication ON results (publication_id, stage);
+            CREATE INDEX IF NOT EXISTS results_year ON results (stage, year, label) WHERE current = 1;
+            CREATE INDEX IF NOT EXISTS results_company ON results (company, stage) WHERE current = 1;
+            CREATE INDEX IF NOT EXISTS results_watch ON results (stage, is_in_issr_watch, is_in_debt_watch, year)
+                WHERE current = 1;
+            CREATE TABLE IF NOT EXISTS rating_changes (
+                result_id INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                publication_id TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                current INTEGER NOT NULL DEFAULT 1,
+                company TEXT COLLATE NOCASE,
+                product TEXT,
+                old_rating TEXT,
+                new_rating TEXT,
+                old_rank INTEGER,
+                new_rank INTEGER,
+                is_downgrade INTEGER NOT NULL,
+                is_upgrade INTEGER NOT NULL,
+                old_speculative INTEGER,
+                new_speculative INTEGER,
+                is_in_issr_watch INTEGER,
+                is_in_debt_watch INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS rating_changes_publication ON rating_changes (publication_id, stage);
+            CREATE INDEX IF NOT EXISTS rating_changes_year ON rating_changes
+                (stage, year, is_downgrade, new_speculative) WHERE current = 1;
+            CREATE INDEX IF NOT EXISTS rating_changes_company ON rating_changes (company, stage) WHERE current = 1;
+            CREATE INDEX IF NOT EXISTS rating_changes_new_rating ON rating_changes (new_rating, stage, year)
+                WHERE current = 1;
+            CREATE INDEX IF NOT EXISTS rating_changes_old_rating ON rating_changes (old_rating, stage, year)
+                WHERE current = 1;
+        """)
+        self.conn.commit()
+
+    def append(self, stage, label, publication_id, year, data: dict):
+        self.append_many(stage, [(label, publication_id, year, data)])
+
+    def append_many(self, stage, rows):
+        """Appends (label, publication_id, year, data) rows in one transaction; older rows of the
+        same publications and stage stop being current."""
+        if stage not in LABELS:
+            raise ValueError(f"unknown stage {stage!r}")
+        now = time.time()
+        with self.conn:
+            for label, publication_id, year, data in rows:
+                if label not in LABELS[stage]:
+                    raise ValueError(f"unknown {stage} label {label!r}")
+                for table in ('results', 'rating_changes'):
+                    self.conn.execute(f"UPDATE {table} SET current = 0 WHERE publication_id = ? AND stage = ? "
+                                      f"AND current = 1", (publication_id, stage))
+                max_match = data.get('Max Match Company') or {}
+                issr_watch, debt_watch = _flag(data.get('Is In ISSR Watch')), _flag(data.get('Is In Debt Watch'))
+                result_id = self.conn.execute(
+                    "INSERT INTO results (stage, label, publication_id, year, company, has_new_rating, "
+                    "report_publish_date, mast_issr_num, is_in_issr_watch, is_in_debt_watch, data, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (stage, label, publication_id, int(year), data.get('Company Name'),
+                     _flag(data.get('Has New Rating') in (True, 'True', 'true')), data.get('report_publish_date'),
+                     issuer_key(max_match.get('Issuer Number')),
+                     issr_watch, debt_watch, json.dumps(data, ensure_ascii=False), now)).lastrowid
+                self.conn.executemany(
+                    "INSERT INTO rating_changes (result_id, stage, publication_id, year, company, product, old_rating, "
+                    "new_rating, old_rank, new_rank, is_downgrade, is_upgrade, old_speculative, new_speculative, "
+                    "is_in_issr_watch, is_in_debt_watch) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((result_id, stage, publication_id, int(year), *change, issr_watch, debt_watch)
+                     for change in rating_change_rows(data)))
+
+    @staticmethod
+    def _where(filters: dict):
+        clauses = ['current = 1']
+        params = []
+        for column, value in filters.items():
+            if value is None:
+                continue
+            clauses.append(f'{column} = ?')
+            params.append(int(value) if isinstance(value, bool) else value)
+        return ' AND '.join(clauses), params
+
+    def publication_ids(self, stage, year=None, label=None) -> set:
+        where, params = self._where({'stage': stage, 'year': year, 'label': label})
+        return {row[0] for row in self.conn.execute(f"SELECT publication_id FROM results WHERE {where}", params)}
+
+    def results(self, stage=PROCESSED, label=None, year=None, publication_id=None, company=None,
+                has_new_rating=None, issr_watch=None, debt_watch=None, limit=None) -> list:
+        """Current results as dicts of publication_id, year, label and the stored `data`."""
+        where, params = self._where({'stage': stage, 'label': label, 'year': year, 'publication_id': publication_id,
+                                     'company': company, 'has_new_rating': has_new_rating,
+                                     'is_in_issr_watch': issr_watch, 'is_in_debt_watch': debt_watch})
+        sql = f"SELECT publication_id, year, label, data FROM results WHERE {where} ORDER BY year, publication_id"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [{'publication_id': publication_id, 'year': year, 'label': label, 'data': json.loads(data)}
+                for publication_id, year, label, data in self.conn.execute(sql, params)]
+
+    def rating_changes(self, stage=PROCESSED, year=None, company=None, old_rating=None, new_rating=None,
+                       downgrade=None, upgrade=None, old_speculative=None, new_speculative=None,
+                       issr_watch=None, debt_watch=None, limit=None) -> list:
+        """Current product rating changes, one dict per product, without the result documents."""
+        where, params = self._where({'stage': stage, 'year': year, 'company': company,
+                                     'old_rating': normalize_rating(old_rating) or old_rating,
+                                     'new_rating': normalize_rating(new_rating) or new_rating,
+                                     'is_downgrade': downgrade, 'is_upgrade': upgrade,
+                                     'old_speculative': old_speculative, 'new_speculative': new_speculative,
+                                     'is_in_issr_watch': issr_watch, 'is_in_debt_watch': debt_watch})
+        sql = (f"SELECT publication_id, year, company, product, old_rating, new_rating, is_in_issr_watch, "
+               f"is_in_debt_watch FROM rating_changes WHERE {where} ORDER BY year, publication_id")
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        columns = ('publication_id', 'year', 'company', 'product', 'old_rating', 'new_rating',
+                   'is_in_issr_watch', 'is_in_debt_watch')
+        return [dict(zip(columns, row)) for row in self.conn.execute(sql, params)]
+
+    def downgrades(self, year=None, to_speculative=False, fallen_angels=False, stage=PROCESSED) -> list:
+        """Downgrades of `year`; `to_speculative` keeps those ending in speculative grade, `fallen_angels`
+        only those that were investment grade before."""
+        return self.rating_changes(stage, year=year, downgrade=True,
+                                   new_speculative=True if to_speculative or fallen_angels else None,
+                                   old_speculative=False if fallen_angels else None)
+
+    def counts(self, stage=PROCESSED, year=None) -> dict:
+        where, params = self._where({'stage': stage, 'year': year})
+        return dict(self.conn.execute(f"SELECT label, COUNT(*) FROM results WHERE {where} GROUP BY label", params))
+
+    def import_files(self, data_path: Path) -> int:
+        """Imports processed/<label>/*.json and matched/<label>/*.json written by earlier runs."""
+        imported = 0
+        for year_path in sorted(Path(data_path).iterdir()):
+            if not year_path.name.isdigit():
+                continue
+            for stage, labels in LABELS.items():
+                rows = []
+                for label in labels:
+                    for result_file in sorted((year_path / stage / label).glob('*.json')):
+                        with open(result_file, 'r') as f:
+                            rows.append((label, result_file.stem, int(year_path.name), json.load(f)))
+                self.append_many(stage, rows)
+                imported += len(rows)
+            logger.info(f"Imported results of {year_path.name}")
+        self.conn.execute("ANALYZE")
+        return imported
+
+    def close(self):
+        # 让查询规划器拿到最新的统计信息，否则按年份排序的查询会选错索引
+        self.conn.execute("PRAGMA optimize")
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import or query the consolidated results store.")
+    parser.add_argument('command', choices=['import', 'counts', 'downgrades'])
+    parser.add_argument('--data-path', default='data', type=Path)
+    parser.add_argument('--store-path', default=Path('data') / 'results.sqlite', type=Path)
+    parser.add_argument('--stage', default=PROCESSED, choices=list(LABELS))
+    parser.add_argument('--year', type=int)
+    parser.add_argument('--speculative', action='store_true', help="only downgrades to speculative grade")
+    args = parser.parse_args()
+    store = ResultStore(args.store_path)
+    if args.command == 'import':
+        logger.info(f"Imported {store.import_files(args.data_path)} result files into {args.store_path}")
+    elif args.command == 'counts':
+        for stage in LABELS:
+            print(stage, store.counts(stage, args.year))
+    else:
+        for change in store.downgrades(args.year, to_speculative=args.speculative, stage=args.stage):
+            print(change)
+    store.close()
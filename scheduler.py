@@ -0,0 +1,140 @@
+import asyncio
+import random
+import time
+from collections import deque
+from functools import lru_cache
+
+import aiohttp
+from loguru import logger
+
+from Agent import LLMResponseError
+from chunking import estimate_tokens
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+@lru_cache(maxsize=16)
+def _prompt_tokens(prompt) -> int:
+    # The same few prompts are sent with every request
+    return estimate_tokens(prompt)
+
+
+class SlidingWindowBudget:
+    """Budget of `limit` units spent over a sliding `window` of seconds."""
+
+    def __init__(self, limit=None, window=60.0):
+        self.limit = limit
+        self.window = window
+        self.events = deque()
+        self.used = 0
+
+    def _expire(self, now):
+        while self.events and self.events[0][0] <= now - self.window:
+            _, amount = self.events.popleft()
+            self.used -= amount
+
+    def wait_time(self, amount, now) -> float:
+        if self.limit is None:
+            return 0.0
+        self._expire(now)
+        if self.used + amount <= self.limit or not self.events:
+            # A single oversized request is let through once the window is empty
+            return 0.0
+        needed = self.used + amount - self.limit
+        for timestamp, spent in self.events:
+            needed -= spent
+            if needed <= 0:
+                return timestamp + self.window - now
+        return self.window
+
+    def record(self, amount, now):
+        if self.limit is None:
+            return
+        self.events.append((now, amount))
+        self.used += amount
+
+
+class RateLimitScheduler:
+    """Paces LLM requests of one provider and retries throttled or failed calls.
+
+    Requests wait for room in the requests-per-minute and tokens-per-minute budgets
+    before being sent. 429/5xx responses and connection errors are retried with
+    jittered exponential backoff, honouring ``Retry-After``; a 429 also pauses every
+    other request of this scheduler. Failures per file are counted separately so the
+    caller can back off the file and finally move it to ``dead_letter``.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=4, max_file_attempts=3,
+                 base_delay=1.0, max_delay=60.0):
+        self.request_budget = SlidingWindowBudget(requests_per_minute)
+        self.token_budget = SlidingWindowBudget(tokens_per_minute)
+        self.max_retries = max_retries
+        self.max_file_attempts = max_file_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempts = {}
+        self.dead_letter = {}
+        self._cooldown_until = 0.0
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def estimate_tokens(input_message, prompt, max_tokens) -> int:
+        # The response is charged against the budget at its maximum size
+        return estimate_tokens(input_message) + _prompt_tokens(prompt) + max_tokens
+
+    def backoff_delay(self, attempt) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def is_retryable(error) -> bool:
+        if isinstance(error, LLMResponseError):
+            return error.status in RETRYABLE_STATUS
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def acquire(self, tokens):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = max(self._cooldown_until - now,
+                           self.request_budget.wait_time(1, now),
+                           self.token_budget.wait_time(tokens, now))
+                if wait <= 0:
+                    self.request_budget.record(1, now)
+                    self.token_budget.record(tokens, now)
+                    return
+                await asyncio.sleep(wait)
+
+    async def get_response(self, agent, input_message, prompt, temperature=0.5, max_tokens=4096, tokens=None):
+        """`tokens` is the request's charge against the token budget; callers that already counted
+        the input pass it so the document is not encoded again on the event loop."""
+        if tokens is None:
+            tokens = self.estimate_tokens(input_message, prompt, max_tokens)
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(tokens)
+            try:
+                return await agent.get_response(input_message=input_message, prompt=prompt,
+                                                temperature=temperature, max_tokens=max_tokens)
+            except Exception as e:
+                if not self.is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if getattr(e, 'status', None) == 429:
+                    self._cooldown_until = max(self._cooldown_until, time.monotonic() + delay)
+                logger.warning(f"model: {agent.model}, attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def record_success(self, key):
+        self.attempts.pop(key, None)
+
+    def record_failure(self, key, error):
+        """Returns the delay before `key` may be retried, or None once it is dead-lettered."""
+        attempts = self.attempts.get(key, 0) + 1
+        self.attempts[key] = attempts
+        if attempts >= self.max_file_attempts:
+            self.attempts.pop(key, None)
+            self.dead_letter[key] = error
+            return None
+        return self.backoff_delay(attempts)
@@ -0,0 +1,20 @@
+from publications.corpus import Corpus, build_corpus
+from publications.detail_store import DetailStore
+
+
+def make_details(title):
+    return {'baseInfo': [{'title': title, 'published_date': '1999-03-03'}],
+            'researchPayload': {'html_content': f'<p>{title}</p>'}}
+
+
+def test_get_does_not_truncate_longer_ids(tmp_path):
+    store = DetailStore(tmp_path / 'store')
+    store.put_many([('PBC_100000', 1999, make_details('first')), ('PBC_100001', 1999, make_details('second'))])
+    build_corpus(tmp_path / 'corpus', store, tmp_path)
+    store.close()
+    with Corpus.open(tmp_path / 'corpus') as corpus:
+        assert corpus.get('PBC_100000').title == 'first'
+        assert 'PBC_100001' in corpus
+        assert corpus.get('PBC_1000001') is None
+        assert 'PBC_1000001' not in corpus
+        assert 'PBC_10000' not in corpus
@@ -0,0 +1,24 @@
+import pytest
+
+from utli import parse_json
+
+
+@pytest.mark.parametrize("text", [
+    "Sorry, I can't help with that.",
+    "No downgrade found.",
+    'here: {"Company Name": "X", "Has New Rating": true',
+])
+def test_unparseable_responses_fail_without_raising(text):
+    _, result, stage = parse_json(text)
+    assert result == {}
+    assert stage == 'failed'
+
+
+def test_no_json_is_failed():
+    assert parse_json("nothing")[1:] == ({}, 'failed')
+
+
+def test_valid_responses_keep_their_stage():
+    assert parse_json('{"a": 1}')[1:] == ({'a': 1}, 'direct')
+    assert parse_json('{}')[1:] == ({}, 'direct')
+    assert parse_json('here:\n```json\n{"a": 1}\n```')[1:] == ({'a': 1}, 'extract')
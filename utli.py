@@ -7,11 +7,21 @@ import json
 import logging
 import re
 import ast
+from collections import Counter
 
 from json_repair import repair_json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
 
+PARSE_STAGES = ('direct', 'extract', 'cleanup', 'repair', 'ast', 'failed')
+# Number of responses parsed by each stage in this process
+parse_stats = Counter()
+
 
 def try_parse_ast_to_json(function_string: str) -> tuple[str, dict]:
     """
@@ -37,20 +47,13 @@ def try_parse_ast_to_json(function_string: str) -> tuple[str, dict]:
     return ast_info, json_result
 
 
-def try_parse_json_object(input: str) -> tuple[str, dict]:
-    """JSON cleaning and formatting utilities."""
-    # Sometimes, the LLM returns a json string with some extra description, this function will clean it up.
+def _loads(text: str):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
 
-    result = None
-    try:
-        # Try parse first
-        result = json.loads(input)
-    except json.JSONDecodeError:
-        log.info("Warning: Error decoding faulty json, attempting repair")
-
-    if result:
-        return input, result
 
+def _legacy_cleanup(input: str) -> str:
     _pattern = r"\{(.*)\}"
     _match = re.search(_pattern, input)
     input = "{" + _match.group(1) + "}" if _match else input
@@ -75,6 +78,91 @@ def try_parse_json_object(input: str) -> tuple[str, dict]:
         input = input[len("```json"):]
     if input.endswith("```"):
         input = input[: len(input) - len("```")]
+    return input
+
+
+def parse_json(input: str) -> tuple[str, dict, str]:
+    """Parses an LLM response through increasingly expensive stages.
+
+    Returns (json_text, result, stage), stage being the first of PARSE_STAGES that produced
+    the result. Responses requested with response_format json_object almost always parse
+    in the first stage; fenced or chatty ones in the second.
+    """
+    # 1. The whole response is JSON
+    try:
+        result = _loads(input)
+    except ValueError:
+        result = None
+    if isinstance(result, dict):
+        return input, result, 'direct'
+
+    # 2. Markdown fences or surrounding text: the outermost braces, found in one scan from each end
+    start = input.find('{')
+    end = input.rfind('}')
+    if 0 <= start < end:
+        candidate = input[start:end + 1]
+        try:
+            result = _loads(candidate)
+        except ValueError:
+            result = None
+        if isinstance(result, dict):
+            return candidate, result, 'extract'
+
+    # 3. The historical clean-up chain (double braces, quoted lists, stray backslashes)
+    input = _legacy_cleanup(input)
+    try:
+        result = json.loads(input)
+    except json.JSONDecodeError:
+        result = None
+    if isinstance(result, dict):
+        return input, result, 'cleanup'
+
+    # 4. Fixup potentially malformed json string using json_repair.
+    json_info = str(repair_json(json_str=input, return_objects=False))
+    try:
+        if len(json_info) < len(input):
+            json_info, result = try_parse_ast_to_json(input)
+            stage = 'ast'
+        else:
+            result = json.loads(json_info)
+            stage = 'repair'
+    except (SyntaxError, ValueError, TypeError, AttributeError, json.JSONDecodeError) as e:
+        # Prose and output truncated at max_tokens are neither JSON nor a Python call expression
+        log.warning("error loading json (%s), json=%.200s", e, input)
+        return json_info, {}, 'failed'
+    if not isinstance(result, dict):
+        log.warning("not expected dict type. type=%s", type(result))
+        return json_info, {}, 'failed'
+    if not result:
+        # repair/ast turn a response without any JSON into {}, which is not a parse
+        log.warning("no json object found, json=%.200s", input)
+        return json_info, {}, 'failed'
+    return json_info, result, stage
+
+
+def try_parse_json_object(input: str) -> tuple[str, dict]:
+    """JSON cleaning and formatting utilities."""
+    # Sometimes, the LLM returns a json string with some extra description, this function will clean it up.
+    json_text, result, stage = parse_json(input)
+    parse_stats[stage] += 1
+    return json_text, result
+
+
+def legacy_try_parse_json_object(input: str) -> tuple[str, dict]:
+    """The parser try_parse_json_object used before the staged ladder, kept for benchmarking."""
+    # Sometimes, the LLM returns a json string with some extra description, this function will clean it up.
+
+    result = None
+    try:
+        # Try parse first
+        result = json.loads(input)
+    except json.JSONDecodeError:
+        log.info("Warning: Error decoding faulty json, attempting repair")
+
+    if result:
+        return input, result
+
+    input = _legacy_cleanup(input)
 
     try:
         result = json.loads(input)
@@ -102,3 +190,66 @@ def try_parse_json_object(input: str) -> tuple[str, dict]:
         return input, result
 
 
+def load_cached_responses(cache_path, limit=None) -> list:
+    """Raw model outputs stored in the LLM response cache (llm_cache.py)."""
+    import sqlite3
+
+    conn = sqlite3.connect(cache_path)
+    query = "SELECT response FROM responses" + (f" LIMIT {int(limit)}" if limit else "")
+    responses = [row[0] for row in conn.execute(query)]
+    conn.close()
+    return responses
+
+
+def _parse_or_error(parse, text):
+    try:
+        return parse(text)[1]
+    except Exception as e:
+        return e
+
+
+def benchmark(responses: list, repeat=3) -> dict:
+    import time
+
+    timings = {}
+    for name, parse in [('legacy', legacy_try_parse_json_object), ('staged', parse_json)]:
+        best = float('inf')
+        raised = 0
+        for _ in range(repeat):
+            raised = 0
+            start = time.perf_counter()
+            for response in responses:
+                raised += isinstance(_parse_or_error(parse, response), Exception)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = {'seconds': best, 'per_response_us': best / len(responses) * 1e6 if responses else 0.0,
+                         'raised': raised}
+    stages = Counter()
+    different = 0
+    for response in responses:
+        try:
+            stages[parse_json(response)[2]] += 1
+        except Exception:
+            stages['raised'] += 1
+        legacy = _parse_or_error(legacy_try_parse_json_object, response)
+        if not isinstance(legacy, Exception) and legacy != _parse_or_error(parse_json, response):
+            different += 1
+    return {'timings': timings, 'stages': dict(stages), 'different_results': different}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(description="Benchmark the staged JSON parser on cached model outputs.")
+    parser.add_argument('--cache-path', default='data/llm_cache.sqlite')
+    parser.add_argument('--limit', default=None, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+    cached_responses = load_cached_responses(args.cache_path, args.limit)
+    print(f"{len(cached_responses)} cached responses, orjson {'enabled' if orjson is not None else 'not installed'}")
+    report = benchmark(cached_responses, args.repeat)
+    for name, timing in report['timings'].items():
+        print(f"{name:>8}: {timing['seconds']:.3f}s, {timing['per_response_us']:.1f} us/response, "
+              f"{timing['raised']} raised")
+    print(f"stages: {report['stages']}, results differing from legacy where legacy parsed: "
+          f"{report['different_results']}")
@@ -0,0 +1,74 @@
+"""Interval index over the ISSR_WATCH / DEBT_WATCH tables.
+
+Rows are sorted by (mast_issr_num, watch_datetime) into NumPy arrays once. "Which watches
+cover issuer X at time T" is then a binary search for the rows of X that started by T,
+filtered on their end. A missing start or end (NaT) leaves the watch open on that side.
+`join` answers the same question for a whole batch of (issuer, time) pairs in one
+vectorised pass.
+"""
+
+import numpy as np
+import pandas as pd
+
+RECORD_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class WatchIndex:
+    def __init__(self, df: pd.DataFrame, key='mast_issr_num', start='watch_datetime', end='watch_end_datetime'):
+        self.df = df.reset_index(drop=True)
+        self.start_column = start
+        self.end_column = end
+        keys = self.df[key].to_numpy()
+        starts = self.df[start].to_numpy(dtype='datetime64[s]')
+        ends = self.df[end].to_numpy(dtype='datetime64[ns]')
+        valid_starts = starts[~np.isnat(starts)].astype(np.int64)
+        self.t_min = int(valid_starts.min()) if len(valid_starts) else 0
+        self.span = (int(valid_starts.max()) if len(valid_starts) else 0) - self.t_min + 1
+        # 开始时间为NaT的watch排在每个发行人的最前面，视为一直有效
+        start_offsets = np.where(np.isnat(starts), 0, starts.astype(np.int64) - self.t_min + 1)
+        self.group_keys, groups = np.unique(keys, return_inverse=True)
+        composite = groups.astype(np.int64) * (self.span + 2) + start_offsets
+        order = np.argsort(composite, kind='stable')
+        self.rows = order
+        self.composite = composite[order]
+        self.group_starts = np.searchsorted(groups[order], np.arange(len(self.group_keys)), side='left')
+        self.ends = np.where(np.isnat(ends), np.iinfo(np.int64).max, ends.astype(np.int64))[order]
+
+    def _groups(self, keys):
+        positions = np.searchsorted(self.group_keys, keys)
+        positions = np.minimum(positions, max(len(self.group_keys) - 1, 0))
+        found = (self.group_keys[positions] == keys) if len(self.group_keys) else np.zeros(len(keys), dtype=bool)
+        return positions, found
+
+    def join(self, keys, times):
+        """Vectorised lookup for many (issuer, time) pairs.
+
+        Returns (query_positions, row_positions): for every pair the positions into `keys`
+        and into the watch table of each watch covering that issuer at that time.
+        """
+        keys = np.asarray(keys)
+        times = pd.to_datetime(pd.Series(times)).to_numpy(dtype='datetime64[ns]')
+        groups, found = self._groups(keys)
+        found &= ~np.isnat(times)
+        if not found.any():
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        offsets = np.clip(times.astype('datetime64[s]').astype(np.int64) - self.t_min + 1, 0, self.span + 1)
+        lo = np.where(found, self.group_starts[groups], 0)
+        hi = np.where(found, np.searchsorted(self.composite, groups * (self.span + 2) + offsets, side='right'), 0)
+        counts = hi - lo
+        query_positions = np.repeat(np.arange(len(keys)), counts)
+        candidates = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        covered = self.ends[candidates] >= times.astype(np.int64)[query_positions]
+        return query_positions[covered], self.rows[candidates[covered]]
+
+    def lookup(self, key, when) -> np.ndarray:
+        """Positions in the watch table of the watches covering issuer `key` at time `when`."""
+        _, rows = self.join([key], [when])
+        return np.sort(rows)
+
+    def records(self, rows) -> list:
+        """Watch rows as JSON-ready dicts, dates formatted the way matched files store them."""
+        matched = self.df.iloc[np.sort(np.asarray(rows))].copy()
+        for column in (self.start_column, self.end_column):
+            matched[column] = matched[column].dt.strftime(RECORD_TIME_FORMAT).fillna('')
+        return matched.to_dict(orient='records')